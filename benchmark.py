@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+"""
+Benchmark harness for validatecities.py, which doesn't need any of the real
+(and in part proprietary) input files.  The benchmark sequence structure is
+summarized in the following logical outline:
+
+    (I) Generate Synthetic Data: writes a country map, a worldcitiespop-style
+    city spelling file (with country sizes spread out as unevenly as in the
+    real file, and names repeated within a country as if from different
+    regions), an airports.dat-style file, and an input file in which a
+    controlled fraction of the city names have typos, transposed letters, or
+    unrecognized country codes, or are repeats of earlier input lines, along
+    with a file of labels giving the correct city name for each input line.
+
+    (II) Time Each Stage: runs the stages of validatecities.py on the
+    synthetic data one at a time and measures how long each of them takes:
+    parsing the city spelling file (and compiling its cache), loading the
+    country map, loading the city spelling file from the compiled cache,
+    loading and averaging the airports, validating the unique input cities
+    (split into exact matching, building the blocking indices, and
+    fixspelling(), or the --matcher engine's indices and lookups), and
+    writing the two output files.  With --agreement, it also compares the
+    case 7 picks of the --matcher engine with those of fixspelling() on the
+    labelled input lines, for both accuracy and speed.
+
+    (III) Report: writes the timings, together with the benchmark parameters
+    and a description of the platform, as JSON, so that results can be kept
+    and compared from one release to the next.
+
+For example, to benchmark with a city spelling file about the size of the
+real one:
+
+    python benchmark.py --cities 3200000 --lines 200000 --output bench.json
+"""
+
+import sys
+import os
+import argparse
+import csv
+import json
+import random
+import shutil
+import tempfile
+import time
+import platform
+import datetime
+from operator import itemgetter
+import validatecities as vc
+
+# Format version of the JSON report; increase this whenever its layout changes
+report_version = 1
+# File names within the benchmark directory
+countrymap_name = "countrymap.txt"
+cityspelling_name = "worldcitiespop.txt"
+airports_name = "airports.dat"
+input_name = "input.txt"
+labels_name = "labels.txt"
+processed_name = "processed_cities.csv"
+unique_name = "unique_cities.csv"
+# Syllables which synthetic city names are built from
+syllables = ["ka", "lo", "mi", "ne", "sta", "ber", "ton", "vil", "gra", "chu",
+             "pol", "dan", "ri", "ko", "zar", "quin", "xe", "wy", "jo", "ham",
+             "burg", "ville", "sk", "ov", "ey", "an", "el", "or", "us", "it"]
+letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Command line options
+parser = argparse.ArgumentParser(description="Benchmark validatecities.py " +
+                                 "on synthetic data")
+parser.add_argument("--countries", type=int, default=200, metavar="N",
+                    help="number of countries (default: %(default)s)")
+parser.add_argument("--cities", type=int, default=300000, metavar="N",
+                    help="number of rows in the city spelling file " +
+                    "(default: %(default)s)")
+parser.add_argument("--airports", type=int, default=5000, metavar="N",
+                    help="number of cities with airports (default: " +
+                    "%(default)s)")
+parser.add_argument("--lines", type=int, default=20000, metavar="N",
+                    help="number of lines in the input file (default: " +
+                    "%(default)s)")
+parser.add_argument("--typo-rate", type=float, default=0.2, metavar="P",
+                    help="fraction of input city names with a letter " +
+                    "added, dropped or replaced (default: %(default)s)")
+parser.add_argument("--transposition-rate", type=float, default=0.05,
+                    metavar="P", help="fraction of input city names with " +
+                    "two adjacent letters swapped (default: %(default)s)")
+parser.add_argument("--duplicate-rate", type=float, default=0.3, metavar="P",
+                    help="fraction of input lines which repeat an earlier " +
+                    "line (default: %(default)s)")
+parser.add_argument("--unknown-rate", type=float, default=0.01, metavar="P",
+                    help="fraction of input lines with an unrecognized " +
+                    "country code (default: %(default)s)")
+parser.add_argument("--seed", type=int, default=1,
+                    help="random seed for the synthetic data (default: " +
+                    "%(default)s)")
+parser.add_argument("--repeat", type=int, default=1, metavar="N",
+                    help="time the stages this many times, and report the " +
+                    "fastest time for each (default: %(default)s)")
+parser.add_argument("--matcher", choices=["difflib", "symspell", "bktree"],
+                    default="difflib",
+                    help="matching engine to benchmark (see " +
+                    "validatecities.py --matcher) (default: %(default)s)")
+parser.add_argument("--max-edit-distance", type=int,
+                    default=vc.matchers.default_maxdistance, metavar="N",
+                    help="largest number of edits which the symspell and " +
+                    "bktree engines will correct (default: %(default)s)")
+parser.add_argument("--agreement", action="store_true",
+                    help="also compare the case 7 picks of --matcher with " +
+                    "those of difflib on a labelled sample, and report " +
+                    "how often they agree, and how often each is correct")
+parser.add_argument("--labels", metavar="FILE",
+                    help="labelled sample for --agreement, with " +
+                    "City|Country|Expected lines (default: the labels " +
+                    "generated with the synthetic input file)")
+parser.add_argument("--dir", metavar="DIR",
+                    help="directory for the synthetic data and output " +
+                    "files; if it already contains synthetic data, that " +
+                    "is reused (default: a temporary directory, removed " +
+                    "afterwards)")
+parser.add_argument("--output", metavar="FILE",
+                    help="write the JSON report to this file rather than " +
+                    "to stdout")
+
+# Progress messages go to stderr, so as not to get mixed up with the report
+def log(msg):
+    sys.stderr.write(msg + "\n")
+    sys.stderr.flush()
+
+# Make up a city name, with some of the punctuation, numbers, etc. found in
+# real city names
+def cityname(rng):
+    name = "".join(rng.choice(syllables) for ii in range(rng.randint(1, 4)))
+    r = rng.random()
+    if r < 0.08:
+        name = name + " " + rng.choice(syllables) + rng.choice(syllables)
+    elif r < 0.11:
+        name = name + "-" + rng.choice(syllables) + "e"
+    elif r < 0.13:
+        name = "saint " + name
+    elif r < 0.14:
+        name = name + "'s " + rng.choice(syllables)
+    elif r < 0.15:
+        name = str(rng.randint(1, 99)) + " " + name
+    elif r < 0.155:
+        name = str(rng.randint(1, 999))
+    elif r < 0.16:
+        name = name + " (" + rng.choice(syllables) + ")"
+    return name
+
+# Two letter country codes, in order
+def countrycodes(n):
+    return [a + b for a in letters for b in letters][:n]
+
+# Keep a uniform random sample of up to size items from a stream of them
+# (reservoir sampling); count is the number of items seen so far, including
+# this one
+def sampleitem(rng, sample, size, count, item):
+    if len(sample) < size:
+        sample.append(item)
+    else:
+        ii = rng.randrange(count)
+        if ii < size:
+            sample[ii] = item
+
+# Write a country map file, a city spelling file with about ncities rows in
+# total, and an airports file with about nairports cities in it.  Returns a
+# random sample of (country code, city name) pairs from the city spelling
+# file, for making up input lines
+def genreference(dirname, ncountries, ncities, nairports, nsample, rng):
+    codes = countrycodes(ncountries)
+    with open(os.path.join(dirname, countrymap_name), "w",
+              encoding=vc.file_encoding) as file:
+        for code in codes:
+            file.write("{0}|Country {0}\n".format(code))
+    # Country sizes are very uneven in the real file (a few countries have
+    # hundreds of thousands of places, many have only a handful)
+    weights = [rng.paretovariate(1.2) for code in codes]
+    total = sum(weights)
+    sample = []
+    airportsample = []
+    count = 0
+    with open(os.path.join(dirname, cityspelling_name), "w",
+              encoding=vc.file_encoding) as file, \
+         open(os.path.join(dirname, airports_name), "w",
+              encoding=vc.file_encoding) as ports:
+        writer = csv.writer(file, lineterminator="\n")
+        ports = csv.writer(ports, lineterminator="\n")
+        writer.writerow(["Country", "City", "AccentCity", "Region",
+                         "Population", "Latitude", "Longitude"])
+        apid = 1
+        for code, weight in zip(codes, weights):
+            nrows = int(ncities*weight/total) + 1
+            # Draw the names from a smaller pool, so that some of them are
+            # repeated, as if they were in different regions
+            pool = [cityname(rng) for ii in range(max(1, nrows*3//4))]
+            for ii in range(nrows):
+                name = rng.choice(pool)
+                accent = name.title()
+                if rng.random() < 0.05:
+                    accent = accent + "é"
+                lat = rng.uniform(-80, 80)
+                lon = rng.uniform(-170, 170)
+                writer.writerow([code.lower(), name, accent,
+                                 "{0:02d}".format(rng.randint(1, 40)), "",
+                                 "{0:.7f}".format(lat),
+                                 "{0:.7f}".format(lon)])
+                count = count + 1
+                sampleitem(rng, sample, nsample, count, (code, name))
+                sampleitem(rng, airportsample, nairports, count,
+                           (code, accent, lat, lon))
+            # Every country has at least one airport
+            ports.writerow([apid, name.title() + " Airport", accent,
+                            "Country " + code, "ABC", "ABCD",
+                            "{0:.6f}".format(lat), "{0:.6f}".format(lon), 100,
+                            0, "U"])
+            apid = apid + 1
+        for code, accent, lat, lon in airportsample:
+            for ii in range(rng.randint(1, 3)):
+                ports.writerow([apid, accent + " Airport", accent,
+                                "Country " + code, "ABC", "ABCD",
+                                "{0:.6f}".format(lat + rng.uniform(-0.2, 0.2)),
+                                "{0:.6f}".format(lon + rng.uniform(-0.2, 0.2)),
+                                100, 0, "U"])
+                apid = apid + 1
+        ports.writerow([apid, "All Airports", accent, "Country " + code, "",
+                        "", "{0:.6f}".format(lat), "{0:.6f}".format(lon), 0,
+                        0, "U"])
+        ports.writerow([apid + 1, "Nowhere", "Nowhere", "Atlantis", "", "",
+                        "1.0", "2.0", 0, 0, "U"])
+    return sample
+
+# Introduce a typo (a letter added, dropped or replaced) into a city name
+def typo(rng, name):
+    ii = rng.randrange(len(name) + 1)
+    op = rng.randrange(3)
+    if op == 0 or len(name) < 2:
+        return name[:ii] + rng.choice(letters) + name[ii:]
+    ii = min(ii, len(name) - 1)
+    if op == 1:
+        return name[:ii] + name[ii+1:]
+    return name[:ii] + rng.choice(letters) + name[ii+1:]
+
+# Swap two adjacent letters of a city name
+def transpose(rng, name):
+    if len(name) < 2:
+        return name
+    ii = rng.randrange(len(name) - 1)
+    return name[:ii] + name[ii+1] + name[ii] + name[ii+2:]
+
+# Write an input file with nlines lines, made up from the sample of city
+# names from the city spelling file, plus a labels file giving the correct
+# city name for each distinct input line (see agreement)
+def geninput(dirname, sample, nlines, typorate, transrate, duprate,
+             unknownrate, rng):
+    written = []
+    with open(os.path.join(dirname, input_name), "w",
+              encoding=vc.file_encoding) as file, \
+         open(os.path.join(dirname, labels_name), "w",
+              encoding=vc.file_encoding) as labels:
+        file.write("City|Country\n")
+        labels.write("City|Country|Expected\n")
+        for ii in range(nlines):
+            if written and rng.random() < duprate:
+                line = rng.choice(written)
+            else:
+                code, name = rng.choice(sample)
+                name = vc.normalize.upper(name)
+                expected = name
+                if rng.random() < typorate:
+                    name = typo(rng, name)
+                if rng.random() < transrate:
+                    name = transpose(rng, name)
+                if rng.random() < unknownrate:
+                    code = "X" + rng.choice(letters)
+                # A leading quote would be taken as a quote character
+                line = "{0}|{1}\n".format(name.lstrip("'"), code)
+                written.append(line)
+                labels.write(line[:-1] + "|" + expected.lstrip("'") + "\n")
+            file.write(line)
+
+# Run each stage of validatecities.py once on the synthetic data in dirname,
+# with the given matching engine, and return the time spent in each stage,
+# plus the Metrics collected by the Validator
+def timestages(dirname, matcher, maxdistance):
+    path = lambda name: os.path.join(dirname, name)
+    cache = vc.cachefilename(path(cityspelling_name))
+    seconds = {}
+    quiet = lambda msg: None
+
+    # Parse the city spelling file, with no compiled cache to fall back on
+    if os.path.exists(cache):
+        os.remove(cache)
+    start = time.perf_counter()
+    vc.loadcityspelling(path(cityspelling_name), cache, quiet)
+    seconds["gazetteer_parse"] = time.perf_counter() - start
+
+    # Load the reference data as usual, from the cache compiled above; the
+    # Validator's metrics record the time taken by each part of this
+    stats = vc.Metrics()
+    validator = vc.Validator(path(countrymap_name), path(cityspelling_name),
+                             path(airports_name), cache, verbose=False,
+                             metrics=stats, matcher=matcher,
+                             maxdistance=maxdistance)
+    seconds.update(stats.stages)
+
+    # Read the input file, and find the unique cities in it
+    start = time.perf_counter()
+    with open(path(input_name), "r", encoding=vc.file_encoding) as infile:
+        alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+        next(alldata) # Skip column headers in first line
+        lines = [(city, ctry) for city, ctry in alldata]
+    pairs = list(dict.fromkeys(lines))
+    seconds["input_read"] = time.perf_counter() - start
+    stats.count("input_lines", len(lines))
+    stats.count("prevseen_hits", len(lines) - len(pairs))
+
+    # Validate the unique cities; the time spent in building blocking (or
+    # matching engine) indices and in fixspelling() (or the matching engine)
+    # is split out from the rest (i.e., exact matching)
+    start = time.perf_counter()
+    results = validator.validate_batch(pairs)
+    elapsed = time.perf_counter() - start
+    seconds["blocking_index"] = \
+        stats.counters.get("blocking_index_seconds", 0.0) + \
+        stats.counters.get("matcher_index_seconds", 0.0)
+    seconds["fixspelling"] = stats.histograms["fixspelling_seconds"].sum + \
+                             stats.histograms["matcher_seconds"].sum
+    seconds["exact_match"] = elapsed - seconds["blocking_index"] - \
+                             seconds["fixspelling"]
+
+    # Write both output files, the same way that validatecities.py does
+    start = time.perf_counter()
+    prevseen = {(v.inputcity, v.inputctry): vc.outputline(v)
+                for v in results}
+    with open(path(processed_name), "w", encoding=vc.file_encoding) as outfile:
+        outfile.writelines(vc.column_headers)
+        for pair in lines:
+            outfile.writelines(prevseen[pair])
+    with open(path(unique_name), "w", encoding=vc.file_encoding) as outfile:
+        outfile.writelines(vc.column_headers)
+        writer = csv.writer(outfile, quotechar = "'",
+                            quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerows(sorted(results, key=itemgetter(2, 1, 0)))
+    seconds["output_writing"] = time.perf_counter() - start
+    return seconds, stats
+
+# Latency summary, in milliseconds, of a list of times in seconds
+def latencies(times):
+    if not times:
+        return {"mean_ms": None, "p50_ms": None, "p99_ms": None}
+    ms = sorted(1000*t for t in times)
+    return {"mean_ms": sum(ms)/len(ms), "p50_ms": ms[len(ms)//2],
+            "p99_ms": ms[min(len(ms) - 1, len(ms)*99//100)]}
+
+# Compare the case 7 picks of a matching engine with those of the original
+# difflib-based fixspelling(), on a labelled sample of input lines (a file
+# with City|Country|Expected lines, where Expected is the correct name of
+# the city).  Only the lines which have no exact match (i.e., which are up to
+# the matching engine) are compared.  A pick is counted as correct if its
+# cleaned up name is the same as that of the expected city
+def agreement(dirname, labelsfile, matcher, maxdistance):
+    path = lambda name: os.path.join(dirname, name)
+    cache = vc.cachefilename(path(cityspelling_name))
+    engines = ["difflib", matcher]
+    validators = [vc.Validator(path(countrymap_name), path(cityspelling_name),
+                               path(airports_name), cache, verbose=False,
+                               matcher=name, maxdistance=maxdistance)
+                  for name in engines]
+    with open(labelsfile, "r", encoding=vc.file_encoding) as file:
+        alldata = csv.reader(file, delimiter = "|", quotechar="'")
+        next(alldata) # Skip column headers in first line
+        labels = list(dict.fromkeys((city, ctry, expected) for city, ctry,
+                                    expected in alldata))
+    tally = {name: {"correct": 0, "wrong": 0, "no_match": 0} for name in
+             engines}
+    times = {name: [] for name in engines}
+    sample = 0
+    agree = 0
+    disagreements = []
+    for city, ctry, expected in labels:
+        if validators[0].validate(city, ctry).quality not in (7, 8):
+            continue
+        sample = sample + 1
+        truth = vc.cleanup(expected)
+        picks = []
+        for name, validator in zip(engines, validators):
+            # Build the country's index first, so that it isn't timed
+            if name == "difflib":
+                validator.candidateblocks(ctry)
+            else:
+                validator.fuzzyindex(ctry)
+            badcity = vc.cleanup(city)
+            start = time.perf_counter()
+            idx = validator.fixcity(badcity, ctry)
+            times[name].append(time.perf_counter() - start)
+            pick = validator.ctspell[ctry].clean[idx[0]] if idx else None
+            if pick is None:
+                tally[name]["no_match"] += 1
+            elif pick == truth:
+                tally[name]["correct"] += 1
+            else:
+                tally[name]["wrong"] += 1
+            picks.append(pick)
+        if picks[0] == picks[1]:
+            agree = agree + 1
+        elif len(disagreements) < 20:
+            disagreements.append({"city": city, "country": ctry,
+                                  "expected": truth, "difflib": picks[0],
+                                  matcher: picks[1]})
+    report = {"labels": len(labels), "sample": sample, "agree": agree,
+              "agreement_rate": float(agree)/sample if sample else None,
+              "engines": {}, "disagreements": disagreements}
+    for name in engines:
+        report["engines"][name] = dict(tally[name], **latencies(times[name]))
+        report["engines"][name]["accuracy"] = \
+            float(tally[name]["correct"])/sample if sample else None
+    return report
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.countries < 1 or args.countries > len(letters)**2:
+        parser.error("--countries must be between 1 and " +
+                     "{0}".format(len(letters)**2))
+    if args.cities < args.countries or args.lines < 1 or args.repeat < 1:
+        parser.error("--cities must be at least --countries, and " +
+                     "--lines and --repeat must be at least 1")
+    if args.agreement and args.matcher == "difflib":
+        parser.error("--agreement needs a --matcher other than difflib")
+    for rate in [args.typo_rate, args.transposition_rate,
+                 args.duplicate_rate, args.unknown_rate]:
+        if rate < 0 or rate > 1:
+            parser.error("rates must be between 0 and 1")
+    dirname = args.dir if args.dir is not None else tempfile.mkdtemp()
+    try:
+        if not os.path.exists(os.path.join(dirname, input_name)) or \
+           not os.path.exists(os.path.join(dirname, labels_name)):
+            os.makedirs(dirname, exist_ok=True)
+            log("Generating synthetic data in " + dirname + "...")
+            start = time.perf_counter()
+            rng = random.Random(args.seed)
+            sample = genreference(dirname, args.countries, args.cities,
+                                  args.airports, max(1000, args.lines),
+                                  rng)
+            geninput(dirname, sample, args.lines, args.typo_rate,
+                     args.transposition_rate, args.duplicate_rate,
+                     args.unknown_rate, rng)
+            log("Synthetic data generated in " +
+                "{0:.1f} s".format(time.perf_counter() - start))
+        else:
+            log("Reusing synthetic data in " + dirname)
+        runs = []
+        for ii in range(args.repeat):
+            start = time.perf_counter()
+            seconds, stats = timestages(dirname, args.matcher,
+                                        args.max_edit_distance)
+            total = time.perf_counter() - start
+            runs.append(dict(seconds, total=total))
+            log("Run {0} of {1}: {2:.2f} s".format(ii + 1, args.repeat,
+                                                   total))
+        if args.agreement:
+            log("Comparing " + args.matcher + " with difflib...")
+            labels = args.labels
+            if labels is None:
+                labels = os.path.join(dirname, labels_name)
+            agreed = agreement(dirname, labels, args.matcher,
+                               args.max_edit_distance)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(dirname)
+
+    report = {
+        "report_version": report_version,
+        "timestamp": datetime.datetime.now().isoformat(),
+        "platform": {"python": platform.python_version(),
+                     "implementation": platform.python_implementation(),
+                     "system": platform.platform(),
+                     "numpy": vc.numpy is not None},
+        "parameters": {k: v for k, v in vars(args).items()
+                       if k not in ("dir", "output")},
+        "data": {"input_lines": stats.counters["input_lines"],
+                 "unique_inputs": stats.counters["input_lines"] -
+                                  stats.counters["prevseen_hits"],
+                 "fixspelling_calls":
+                     stats.histograms["fixspelling_seconds"].count +
+                     stats.histograms["matcher_seconds"].count,
+                 "blocking_indices": stats.counters.get("blocking_indices",
+                                                        0) +
+                                     stats.counters.get("matcher_indices",
+                                                        0)},
+        "quality_counts": stats.snapshot()["quality_counts"],
+        # Fastest time for each stage over all of the runs, in seconds
+        "stages": {stage: min(run[stage] for run in runs)
+                   for stage in runs[0]},
+        "runs": runs,
+        "peak_memory_mb": vc.peakmemory(),
+    }
+    if args.agreement:
+        report["agreement"] = agreed
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+        log("Benchmark report is written to " + args.output)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Alternative engines for correcting misspelled city names, for use in place of
+the difflib-based fixspelling() in validatecities.py (see --matcher).  Both
+of them index the distinct cleaned up city names of one country once, and
+then look up the names which are within a bounded edit distance of a
+misspelled name, returning all of those at the smallest distance found:
+
+    SymSpellIndex: a symmetric deletion index (as in SymSpell), which maps
+    every string that can be made by deleting up to maxdistance characters
+    from the start of a name to the names it came from.  Lookups only need
+    to generate the deletions of the misspelled name, so they take about the
+    same time however many names there are, at the cost of a large index.
+    Distances are optimal string alignment distances, so that swapping two
+    adjacent letters counts as a single edit.
+
+    BKTree: a Burkhard-Keller tree, which arranges the names by their
+    Levenshtein distances from one another, so that a lookup can skip whole
+    subtrees of names which the triangle inequality shows are too far away.
+    The tree is small, but lookups still compare against a sizable fraction
+    of the names.  Swapping two adjacent letters counts as two edits here.
+"""
+
+# Default bound on the edit distance of a correction, and the number of
+# leading characters of each name which SymSpellIndex generates deletions
+# from (only the deletions of this prefix are indexed, which keeps the index
+# a manageable size without missing any matches)
+default_maxdistance = 2
+default_prefixlength = 7
+
+# Edit distance between strings a and b, or bound + 1 if it's larger than
+# bound.  Counts insertions, deletions and substitutions, plus transpositions
+# of two adjacent characters if transpositions is set (i.e., the optimal
+# string alignment distance)
+def editdistance(a, b, bound, transpositions=True):
+    if len(a) > len(b):
+        a, b = b, a
+    la = len(a)
+    lb = len(b)
+    if lb - la > bound:
+        return bound + 1
+    before = None
+    prev = list(range(lb + 1))
+    for ii in range(1, la + 1):
+        ca = a[ii-1]
+        cur = [ii]*(lb + 1)
+        rowmin = ii
+        for ij in range(1, lb + 1):
+            cb = b[ij-1]
+            d = prev[ij-1] if ca == cb else prev[ij-1] + 1
+            if prev[ij] + 1 < d:
+                d = prev[ij] + 1
+            if cur[ij-1] + 1 < d:
+                d = cur[ij-1] + 1
+            if transpositions and ii > 1 and ij > 1 and ca == b[ij-2] and \
+               a[ii-2] == cb and before[ij-2] + 1 < d:
+                d = before[ij-2] + 1
+            cur[ij] = d
+            if d < rowmin:
+                rowmin = d
+        if rowmin > bound:
+            return bound + 1
+        before = prev
+        prev = cur
+    return prev[lb] if prev[lb] <= bound else bound + 1
+
+# All of the strings which can be made by deleting up to maxdistance
+# characters from s, including s itself
+def deletions(s, maxdistance):
+    found = {s}
+    level = [s]
+    for ii in range(maxdistance):
+        following = []
+        for t in level:
+            if len(t) == 0:
+                continue
+            for ij in range(len(t)):
+                u = t[:ij] + t[ij+1:]
+                if u not in found:
+                    found.add(u)
+                    following.append(u)
+        level = following
+    return found
+
+class SymSpellIndex(object):
+
+    def __init__(self, names, maxdistance=default_maxdistance,
+                 prefixlength=default_prefixlength):
+        self.names = names
+        self.maxdistance = maxdistance
+        self.prefixlength = prefixlength
+        # Each deletion maps to the position in names of the one name which
+        # it came from, or to a list of positions if there are several
+        self.index = {}
+        index = self.index
+        for ii in range(len(names)):
+            for s in deletions(names[ii][:prefixlength], maxdistance):
+                entry = index.get(s)
+                if entry is None:
+                    index[s] = ii
+                elif type(entry) is list:
+                    entry.append(ii)
+                else:
+                    index[s] = [entry, ii]
+
+    # Names closest to word (in the order in which they were indexed), if
+    # any are within maxdistance of it
+    def lookup(self, word):
+        if len(word) == 0:
+            return []
+        best = self.maxdistance
+        found = []
+        seen = set()
+        for s in deletions(word[:self.prefixlength], self.maxdistance):
+            entry = self.index.get(s)
+            if entry is None:
+                continue
+            for ii in (entry if type(entry) is list else [entry]):
+                if ii in seen:
+                    continue
+                seen.add(ii)
+                d = editdistance(word, self.names[ii], best)
+                if d < best:
+                    best = d
+                    found = [ii]
+                elif d == best:
+                    found.append(ii)
+        return [self.names[ii] for ii in sorted(found)]
+
+class BKTree(object):
+
+    def __init__(self, names, maxdistance=default_maxdistance):
+        self.names = names
+        self.maxdistance = maxdistance
+        # Each node is a list of the position in names of its name, and a
+        # dictionary of its children keyed by their distance from it
+        self.root = None
+        for ii in range(len(names)):
+            self.insert(ii)
+
+    def insert(self, ii):
+        if self.root is None:
+            self.root = [ii, {}]
+            return
+        node = self.root
+        name = self.names[ii]
+        while True:
+            d = editdistance(name, self.names[node[0]], len(name) +
+                             len(self.names[node[0]]), False)
+            if d == 0: # Names are all distinct, but just in case
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [ii, {}]
+                return
+            node = child
+
+    # Names closest to word (in the order in which they were indexed), if
+    # any are within maxdistance of it
+    def lookup(self, word):
+        if len(word) == 0 or self.root is None:
+            return []
+        best = self.maxdistance
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            name = self.names[node[0]]
+            # The exact distance is needed (not just whether it's within
+            # best) to know which children could be close enough
+            d = editdistance(word, name, len(word) + len(name), False)
+            if d < best:
+                best = d
+                found = [node[0]]
+            elif d == best:
+                found.append(node[0])
+            for key, child in node[1].items():
+                if d - best <= key <= d + best:
+                    stack.append(child)
+        return [self.names[ii] for ii in sorted(found)]
+
+# Names of the available engines, and the class implementing each
+engines = {"symspell": SymSpellIndex, "bktree": BKTree}
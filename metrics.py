@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+Run metrics for validatecities.py.  A Metrics object collects the wall time
+spent in each stage of a run, counters (including the number of input cities
+with each quality indicator, and hits in the dictionary of previously seen
+cities), histograms of validation latency and of the amount of work done in
+each stage of fixspelling(), and the slowest few input cities.  Everything is
+kept in fixed-size structures, so collecting metrics is cheap enough to leave
+on for every run.  Snapshots of the metrics can be written out periodically,
+either as JSON or in the Prometheus text exposition format, and metrics
+collected in worker processes can be merged back into the main process.
+"""
+
+import os
+import json
+import time
+import heapq
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets for latencies (in seconds) and for
+# amounts of work (numbers of candidates, calls, or iterations); anything
+# larger goes into a final, unbounded bucket
+latency_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+count_buckets = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                 10000, 20000, 50000]
+
+# Histograms which are always present, with their bucket bounds and a
+# description of each
+histogram_specs = [
+    ("validate_seconds", latency_buckets,
+     "time taken to validate each input city"),
+    ("fixspelling_seconds", latency_buckets,
+     "time taken by each call to fixspelling()"),
+    ("fixspelling_stage1_seconds", latency_buckets,
+     "time taken by stage one (candidate screening) of fixspelling()"),
+    ("fixspelling_stage2_seconds", latency_buckets,
+     "time taken by stage two (longest substrings) of fixspelling()"),
+    ("fixspelling_stage3_seconds", latency_buckets,
+     "time taken by stage three (leftover letters) of fixspelling()"),
+    ("matcher_seconds", latency_buckets,
+     "time taken by each lookup with the symspell or bktree engines"),
+    ("fixspelling_stage1_candidates", count_buckets,
+     "candidates passing the stage one screen of fixspelling()"),
+    ("fixspelling_stage2_difflib_calls", count_buckets,
+     "longest common substring searches in stage two of fixspelling()"),
+    ("fixspelling_stage3_iterations", count_buckets,
+     "longest common substring searches in stage three of fixspelling()"),
+]
+
+# Fixed-bucket histogram; counts[ii] is the number of observations no greater
+# than bounds[ii] (and greater than the bound before it), with the last count
+# for observations above all of the bounds
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def merge(self, other):
+        for ii in range(len(self.counts)):
+            self.counts[ii] += other.counts[ii]
+        self.sum = self.sum + other.sum
+        self.count = self.count + other.count
+
+    # Approximate value below which the given fraction of observations fall
+    # (the upper bound of the bucket which it lands in, or "+Inf" for the
+    # last bucket)
+    def quantile(self, frac):
+        if self.count == 0:
+            return None
+        target = frac*self.count
+        total = 0
+        for ii in range(len(self.bounds)):
+            total = total + self.counts[ii]
+            if total >= target:
+                return self.bounds[ii]
+        return "+Inf"
+
+    def asdict(self):
+        return {"buckets": [[bound, count] for bound, count in
+                            zip(self.bounds + ["+Inf"], self.counts)],
+                "sum": self.sum, "count": self.count,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class Metrics(object):
+
+    def __init__(self, slowest=20):
+        self.started = time.time()
+        self.nslowest = slowest
+        self.reset()
+        self.snapshotfile = None
+        self.lastsnapshot = None
+
+    # Discard everything collected so far (but not the snapshot settings)
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.quality = {}
+        self.histograms = {name: Histogram(bounds) for name, bounds, desc in
+                           histogram_specs}
+        # Min-heap of (seconds, city, country, quality) for the slowest
+        # inputs, so that the fastest of them is the one to be replaced (see
+        # addslowest)
+        self.slowest = []
+
+    # Context manager which adds the time spent within it to a stage
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def addstage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    # Time each item taken from an iterable as part of a stage
+    def timediter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.addstage(name, time.perf_counter() - start)
+                return
+            self.addstage(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def countquality(self, quality, n=1):
+        self.quality[quality] = self.quality.get(quality, 0) + n
+
+    # Record the validation of one input city, which took the given time
+    def observe(self, v, seconds):
+        self.countquality(v[2])
+        self.histograms["validate_seconds"].observe(seconds)
+        self.addslowest((seconds, v[0], v[1], v[2]))
+
+    # Add an entry to the slowest inputs, if it's slow enough.  Each (city,
+    # country) pair appears at most once, with its slowest time, so that an
+    # input which is validated more than once (e.g., in --serve mode) doesn't
+    # give duplicate Prometheus samples
+    def addslowest(self, entry):
+        full = len(self.slowest) >= self.nslowest
+        if full and (self.nslowest == 0 or entry[0] <= self.slowest[0][0]):
+            return
+        for ii, old in enumerate(self.slowest):
+            if old[1] == entry[1] and old[2] == entry[2]:
+                if entry[0] > old[0]:
+                    self.slowest[ii] = entry
+                    heapq.heapify(self.slowest)
+                return
+        if full:
+            heapq.heapreplace(self.slowest, entry)
+        else:
+            heapq.heappush(self.slowest, entry)
+
+    # Record one call to fixspelling(), given the list of statistics that it
+    # filled in: the numbers of stage one candidates and of stage two and
+    # stage three longest common substring searches, and the time taken by
+    # each stage
+    def observefix(self, fixstats):
+        hist = self.histograms
+        hist["fixspelling_stage1_candidates"].observe(fixstats[0])
+        hist["fixspelling_stage2_difflib_calls"].observe(fixstats[1])
+        hist["fixspelling_stage3_iterations"].observe(fixstats[2])
+        hist["fixspelling_stage1_seconds"].observe(fixstats[3])
+        hist["fixspelling_stage2_seconds"].observe(fixstats[4])
+        hist["fixspelling_stage3_seconds"].observe(fixstats[5])
+        hist["fixspelling_seconds"].observe(fixstats[3] + fixstats[4] +
+                                            fixstats[5])
+
+    # Add in the metrics collected by another Metrics object (e.g., in a
+    # worker process)
+    def merge(self, other):
+        for name, seconds in other.stages.items():
+            self.addstage(name, seconds)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for quality, n in other.quality.items():
+            self.countquality(quality, n)
+        for name, hist in other.histograms.items():
+            self.histograms[name].merge(hist)
+        for entry in other.slowest:
+            self.addslowest(entry)
+
+    # Fraction of input lines whose city had already been seen earlier in the
+    # input, or None if there haven't been any input lines yet
+    def prevseenrate(self):
+        lines = self.counters.get("input_lines", 0)
+        if lines == 0:
+            return None
+        return float(self.counters.get("prevseen_hits", 0))/lines
+
+    def snapshot(self):
+        return {"timestamp": time.time(),
+                "elapsed_seconds": time.time() - self.started,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+                "quality_counts": {str(k): self.quality[k] for k in
+                                   sorted(self.quality)},
+                "prevseen_hit_rate": self.prevseenrate(),
+                "histograms": {name: hist.asdict() for name, hist in
+                               self.histograms.items()},
+                "slowest_inputs": [{"city": city, "country": ctry,
+                                    "quality": quality, "seconds": seconds}
+                                   for seconds, city, ctry, quality in
+                                   sorted(self.slowest, reverse=True)]}
+
+    # The metrics in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        def metric(name, kind, desc, samples):
+            name = "validatecities_" + name
+            lines.append("# HELP {0} {1}".format(name, desc))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for suffix, labels, value in samples:
+                labels = ",".join('{0}="{1}"'.format(k, promescape(str(v)))
+                                  for k, v in labels)
+                if labels:
+                    labels = "{" + labels + "}"
+                lines.append("{0}{1}{2} {3}".format(name, suffix, labels,
+                                                    promvalue(value)))
+        metric("stage_seconds_total", "counter",
+               "wall time spent in each stage of the run",
+               [("", [("stage", k)], v) for k, v in
+                sorted(self.stages.items())])
+        for name in sorted(self.counters):
+            metric(name + "_total", "counter", name.replace("_", " "),
+                   [("", [], self.counters[name])])
+        metric("quality_total", "counter",
+               "input cities validated with each quality indicator",
+               [("", [("quality", k)], self.quality[k]) for k in
+                sorted(self.quality)])
+        if self.prevseenrate() is not None:
+            metric("prevseen_hit_ratio", "gauge",
+                   "fraction of input lines whose city was seen before",
+                   [("", [], self.prevseenrate())])
+        for name, bounds, desc in histogram_specs:
+            hist = self.histograms[name]
+            samples = []
+            total = 0
+            for bound, count in zip(bounds + ["+Inf"], hist.counts):
+                total = total + count
+                samples.append(("_bucket", [("le", bound)], total))
+            samples.append(("_sum", [], hist.sum))
+            samples.append(("_count", [], hist.count))
+            metric(name, "histogram", desc, samples)
+        metric("slowest_input_seconds", "gauge",
+               "time taken to validate the slowest input cities",
+               [("", [("city", city), ("country", ctry)], seconds) for
+                seconds, city, ctry, quality in
+                sorted(self.slowest, reverse=True)])
+        return "\n".join(lines) + "\n"
+
+    # Write snapshots to this file (as Prometheus text if the format is
+    # "prometheus", otherwise as JSON), at most once per interval seconds
+    def snapshotto(self, filename, format="json", interval=60):
+        self.snapshotfile = filename
+        self.snapshotformat = format
+        self.snapshotinterval = interval
+
+    # Write a snapshot, if snapshots are wanted and either one is due or
+    # force is set.  The file is replaced in one step, so that readers never
+    # see a partly written snapshot
+    def writesnapshot(self, force=False):
+        if self.snapshotfile is None:
+            return
+        now = time.time()
+        if not force and self.lastsnapshot is not None and \
+           now - self.lastsnapshot < self.snapshotinterval:
+            return
+        if self.snapshotformat == "prometheus":
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2, sort_keys=True) + "\n"
+        tmpfile = self.snapshotfile + ".tmp"
+        with open(tmpfile, "w") as file:
+            file.write(text)
+        os.replace(tmpfile, self.snapshotfile)
+        self.lastsnapshot = now
+
+class StageTimer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.addstage(self.name, time.perf_counter() - self.start)
+
+# Escape a Prometheus label value
+def promescape(s):
+    return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def promvalue(value):
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Fast city name normalization for validatecities.py.  The normalize() function
+applies exactly the same rules as the original cleanup() routine (upper case,
+nuisance punctuation replaced or removed, digits removed except for a leading
+number followed by some alphabetic characters, and runs of spaces collapsed),
+but with the character substitutions done in single passes by precompiled
+translation tables, and the regular expressions compiled once up front.  The
+normalize_many() function applies the same rules to a whole list of names at
+once, optionally remembering the results for names which repeat.
+"""
+
+import re
+import string
+
+# Python 2 upper cased the raw bytes of a name, which only ever changed the
+# ASCII letters a-z; str.upper() would also change accented letters, and even
+# turn some of them into characters which can't be written back out in the
+# files' encoding (e.g., "\xff" into "\u0178"), or into two letters (e.g.,
+# "\xdf" into "SS").  Likewise, Python 2 stripped only ASCII whitespace from
+# the ends of a name, and not e.g. a non-breaking space
+upper_table = str.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+whitespace = " \t\n\r\x0b\x0c"
+
+# Characters which are replaced by a space or removed outright.  None of these
+# substitutions can affect one another, so they are all done in a single pass
+punctuation_table = str.maketrans({'-': ' ', '.': ' ', ',': ' ', '/': ' ',
+                                   '(': None, ')': None, '\\': None,
+                                   '"': None, '?': None, '`': ' '})
+# Any apostrophe left over after "'S" has been replaced by "S" (which has to
+# happen after the removals above, since they can bring a "'" and an "S"
+# together) is replaced by a space
+apostrophe_table = str.maketrans({"'": ' '})
+digits_table = str.maketrans('', '', '0123456789')
+# Any character which one of the rules above applies to; most names don't
+# contain any of them, and only need their spaces tidied up
+special_chars = re.compile('[' + re.escape(''.join(map(chr,
+                                                        punctuation_table))) +
+                           "'0-9]")
+leading_number = re.compile('[0-9]+')
+any_letter = re.compile('[A-Z]')
+spaces = re.compile(' +')
+
+# All of the data which the normalization rules depend on, so that anything
+# derived from normalized names (e.g., the compiled city spelling cache) can
+# be recognized as stale if it changes
+rules = [sorted(upper_table.items()), whitespace,
+         sorted(punctuation_table.items()), sorted(apostrophe_table.items()),
+         sorted(digits_table.items()), special_chars.pattern,
+         leading_number.pattern, any_letter.pattern, spaces.pattern]
+
+# Upper case only the ASCII letters in a string, as Python 2 did (see
+# upper_table); most names are entirely ASCII, and str.upper() does the same
+# thing for those, only faster
+def upper(s):
+    if s.isascii():
+        return s.upper()
+    return s.translate(upper_table)
+
+# Clean up nuisance characters, extra spaces, and any numbers except for
+# leading numbers followed by some characters in the alphabet
+def normalize(s):
+    cls = upper(s)
+    if special_chars.search(cls) is not None:
+        cls = cls.translate(punctuation_table)
+        if "'" in cls:
+            cls = cls.replace("'S", "S").translate(apostrophe_table)
+        leadnum = leading_number.match(cls)
+        if leadnum is None: # Usual case: string does not start with a number
+            cls = cls.translate(digits_table)
+        else: # Less common: string *does* start with a number
+            trail = cls.translate(digits_table)
+            # If there are alphabetic characters, use the leading number plus
+            # those
+            if any_letter.search(trail) is not None:
+                cls = leadnum.group() + trail
+            # If the string consists of *only* numeric characters, null it out
+            else:
+                cls = ''
+    if '  ' in cls:
+        cls = spaces.sub(' ', cls)
+    return cls.strip(whitespace)
+
+# Normalize a whole list of names at once, returning a list of the results in
+# the same order.  If a memo dictionary is provided, it's used to look up names
+# which have already been normalized before, and the new results are added to
+# it; the same dictionary can be passed in to any number of calls
+def normalize_many(names, memo=None):
+    if memo is None:
+        return [normalize(name) for name in names]
+    results = []
+    for name in names:
+        cls = memo.get(name)
+        if cls is None:
+            cls = normalize(name)
+            memo[name] = cls
+        results.append(cls)
+    return results
@@ -0,0 +1,118 @@
+# The modules under test live at the top of the repository, alongside the
+# validatecities.py script, rather than in a package
+import os
+import subprocess
+import sys
+
+import pytest
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+import validatecities as vc
+
+# A small set of reference and input files, covering every quality code,
+# averaged airport locations, coordinates which need more than 12 significant
+# digits, and non-ASCII names
+small_countrymap = "DE|Germany\nFR|France\nUS|United States\n"
+small_cities = """\
+Country,City,AccentCity,Region,Population,Latitude,Longitude
+fr,paris,Paris,A8,,48.8566667,2.3508333
+us,paris,Paris,TX,,33.6608333,-95.5555556
+us,paris,Paris,TN,,36.3019444,-88.3266667
+us,springfield,Springfield,IL,,39.8016667,-89.6436111
+us,springfield,Springfield,MA,,42.1013889,-72.5902778
+us,dallas,Dallas,TX,,32.7833333,-96.8
+us,dallas,Dallas,GA,,33.9236111,-84.8408333
+us,north pole,North Pole,AK,,64.7511111,-147.3494444
+us,north pole,North Pole,NY,,44.3130556,-73.9222222
+us,new york,New York,NY,,40.7141667,-74.0063889
+us,saint louis,Saint Louis,MO,,38.6272222,-90.1977778
+fr,lyon,Lyon,B9,,45.75,4.85
+fr,marseille,Marseille,B8,,43.2965234567891,5.3697800000001
+fr,nice,Nice,B8,,43.7,7.25
+fr,l'haÿ-les-roses,L'Haÿ-les-Roses,A8,,48.78,2.3372222
+de,straße,Straße,01,,50,8
+de,strasse,Strasse,01,,50.1,8.2
+de,köln,Köln,07,,50.9333333,6.95
+de,münchen,München,02,,48.15,11.5833333
+de,berlin,Berlin,16,,52.5166667,13.4
+de,0,Zero,16,,0.0001,-1e-05
+"""
+small_airports = """\
+1,"Charles de Gaulle","Paris","France","CDG","LFPG",49.012779,2.55,392,1,"E"
+2,"Orly","Paris","France","ORY","LFPO",48.725278,2.359444,291,1,"E"
+3,"Le Bourget","Paris","France","LBG","LFPB",48.969444,2.441389,218,1,"E"
+4,"Springfield Capital","Springfield","United States","SPI","KSPI",\
+39.844056,-89.677944,598,-6,"A"
+5,"Springfield Branson","Springfield","United States","SGF","KSGF",\
+37.245667,-93.388639,1268,-6,"A"
+6,"North Pole One","North Pole","United States","NP1","NPA1",78.946862,0.1,\
+0,-6,"A"
+7,"North Pole Two","North Pole","United States","NP2","NPA2",78.946863,0.2,\
+0,-6,"A"
+8,"Dallas Love","Dallas","United States","DAL","KDAL",32.847111,-96.851778,\
+487,-6,"A"
+9,"Dallas Fort Worth","Dallas","United States","DFW","KDFW",32.896828,\
+-97.037997,607,-6,"A"
+"""
+small_input = """\
+City|Country
+PARIS|FR
+PARIS|US
+Paris|FR
+SPRINGFIELD|US
+NEW YORK|US
+NEW-YORK|US
+ST. LOUIS|US
+SAINT LUOIS|US
+MARSEILLE|FR
+MARSIELLE|FR
+LYON|FR
+NICE|FR
+L'HAÿ LES ROSES|FR
+STRAßE|DE
+straße|DE
+KöLN|DE
+KÖLN|DE
+MUNCHEN|DE
+BERLIN|DE
+BERLIN|DE
+0|DE
+ZZYZX|US
+TOKYO|JP
+NORTH POLE|US
+NORTH  POLE|US
+PARIS|FR
+DALLAS|US
+"""
+
+# Write the small set of files into a temporary directory, under the names
+# which the script uses by default, and return the directory
+@pytest.fixture
+def smallrun(tmp_path):
+    for filename, text in [(vc.countrymap_file, small_countrymap),
+                           (vc.cityspelling_file, small_cities),
+                           (vc.airports_file, small_airports),
+                           (vc.unvalid_file, small_input)]:
+        with open(str(tmp_path / filename), "w",
+                  encoding=vc.file_encoding) as file:
+            file.write(text)
+    return tmp_path
+
+# Run validatecities.py as a separate process in a directory, with the given
+# command line options, failing the test if it doesn't succeed (unless check
+# is turned off).  Returns the subprocess.CompletedProcess, with stdout and
+# stderr together in its stdout
+@pytest.fixture
+def runscript():
+    def run(dirname, *args, check=True):
+        result = subprocess.run([sys.executable,
+                                 os.path.join(repository, "validatecities.py")]
+                                + list(args), cwd=str(dirname),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        if check:
+            assert result.returncode == 0, result.stdout.decode("latin-1")
+        return result
+    return run
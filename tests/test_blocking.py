@@ -0,0 +1,96 @@
+# Stage one of fixspelling() with the blocking index, whether it uses NumPy or
+# not, must pass exactly the same candidates as the original full scan,
+# including for names with characters that share the overflow bit
+
+import random
+
+import pytest
+
+import benchmark
+import validatecities as vc
+
+# Stage one of fixspelling() without a blocking index: every candidate which
+# shares a long token with badcity, or has 70% of its letters in common
+def fullscan(badcity, candidates):
+    idx = []
+    ctytoken = badcity.split()
+    for ii in range(len(candidates)):
+        cndtoken = candidates[ii].split()
+        matched = False
+        for ij in ctytoken:
+            if len(ij) > 2:
+                for ik in cndtoken:
+                    if len(ik) > 2 and ij == ik:
+                        matched = True
+        if matched:
+            idx.append(ii)
+            continue
+        if vc.lettersincommon(badcity, candidates[ii]):
+            idx.append(ii)
+    return idx
+
+# Far more distinct characters than a mask has bits for, so that the rarer
+# ones share the overflow bit
+rare_chars = [chr(0x100 + ii) for ii in range(120)]
+
+def garble(rng, name):
+    chars = list(name)
+    for ii in range(rng.randint(1, 4)):
+        chars.insert(rng.randint(0, len(chars)), rng.choice(rare_chars))
+    return "".join(chars)
+
+# Candidate names for one made up country, some with rare characters, and
+# misspellings of them (plus some names with only rare characters)
+def corpus(seed):
+    rng = random.Random(seed)
+    candidates = []
+    for ii in range(2000):
+        name = vc.cleanup(benchmark.cityname(rng))
+        if rng.random() < 0.1:
+            name = garble(rng, name)
+        candidates.append(name)
+    candidates.extend(["", "A", "".join(rare_chars[0:70])])
+    queries = []
+    for ii in range(500):
+        name = rng.choice(candidates)
+        r = rng.random()
+        if r < 0.3:
+            name = benchmark.typo(rng, name)
+        elif r < 0.5:
+            name = benchmark.transpose(rng, name)
+        elif r < 0.7:
+            name = garble(rng, name)
+        elif r < 0.8:
+            name = "".join(rng.choice(rare_chars) for ij in range(8))
+        else:
+            name = vc.cleanup(benchmark.cityname(rng))
+        if name:
+            queries.append(name)
+    return candidates, queries
+
+def checkscreen(candidates, queries):
+    blocks = vc.blockcities(candidates)
+    assert any(mask & vc.overflow_bit for mask in blocks[3].tolist())
+    for badcity in queries:
+        assert vc.screencandidates(badcity, candidates, blocks) == \
+            fullscan(badcity, candidates), badcity
+
+def test_screen_matches_full_scan_without_numpy(monkeypatch):
+    monkeypatch.setattr(vc, "numpy", None)
+    checkscreen(*corpus(3))
+
+def test_screen_matches_full_scan_with_numpy():
+    if vc.numpy is None:
+        pytest.skip("NumPy is not installed")
+    checkscreen(*corpus(3))
+
+# blockcandidates() on its own must never leave out a candidate which has
+# 70% of its letters in common
+def test_blockcandidates_recall():
+    candidates, queries = corpus(30)
+    blocks = vc.blockcities(candidates)
+    for badcity in queries:
+        pool = set(vc.blockcandidates(badcity, blocks, len(candidates)))
+        for ii in range(len(candidates)):
+            if vc.lettersincommon(badcity, candidates[ii]):
+                assert ii in pool, (badcity, candidates[ii])
@@ -0,0 +1,72 @@
+# The compiled city spelling cache: a damaged cache must be rejected rather
+# than loaded, and failing to write one mustn't stop the city spelling file
+# from being loaded
+
+import os
+
+import validatecities as vc
+
+def writegazetteer(path):
+    with open(path, "w", encoding=vc.file_encoding) as file:
+        file.write("Country,City,AccentCity,Region,Population,Latitude," +
+                   "Longitude\n")
+        for ii in range(200):
+            file.write("{0},city{1},City{1},01,,{2},{3}\n".format(
+                ["us", "fr", "de"][ii % 3], ii % 50, ii*0.5, -ii*0.25))
+
+def load(filename, cachefile, messages=None):
+    log = messages.append if messages is not None else lambda msg: None
+    return vc.loadcityspelling(filename, cachefile, log)[0]
+
+def sametables(a, b):
+    assert sorted(a.keys()) == sorted(b.keys())
+    for ctry in a.keys():
+        for ii in range(len(a[ctry])):
+            assert (a[ctry].city[ii], a[ctry].clean[ii], a[ctry].accent[ii],
+                    a[ctry].lat[ii], a[ctry].lon[ii]) == \
+                   (b[ctry].city[ii], b[ctry].clean[ii], b[ctry].accent[ii],
+                    b[ctry].lat[ii], b[ctry].lon[ii])
+
+def test_cache_round_trip_leaves_no_temporary_files(tmp_path):
+    filename = str(tmp_path / "cities.txt")
+    cachefile = str(tmp_path / "cities.cache")
+    writegazetteer(filename)
+    parsed = load(filename, cachefile)
+    assert sorted(os.listdir(str(tmp_path))) == ["cities.cache",
+                                                 "cities.txt"]
+    sametables(parsed, vc.readcache(cachefile, vc.fingerprint(filename))[0])
+
+# Cut the cache short at every 8 byte boundary (where a block could end); no
+# truncated version may be loaded
+def test_truncated_cache_is_rejected(tmp_path):
+    filename = str(tmp_path / "cities.txt")
+    cachefile = str(tmp_path / "cities.cache")
+    writegazetteer(filename)
+    load(filename, cachefile)
+    fprint = vc.fingerprint(filename)
+    with open(cachefile, "rb") as file:
+        data = file.read()
+    truncated = str(tmp_path / "truncated.cache")
+    for size in range(0, len(data), 8):
+        with open(truncated, "wb") as file:
+            file.write(data[:size])
+        assert vc.readcache(truncated, fprint) is None, size
+
+def test_unwritable_cache_is_skipped(tmp_path):
+    filename = str(tmp_path / "cities.txt")
+    writegazetteer(filename)
+    cachefile = str(tmp_path / "missing" / "cities.cache")
+    messages = []
+    ctspell = load(filename, cachefile, messages)
+    assert any("could not be written" in msg for msg in messages)
+    sametables(ctspell, load(filename, str(tmp_path / "cities.cache")))
+    # Only some of the countries: since no cache can be compiled, the rows
+    # for the other countries are skipped rather than parsed
+    messages = []
+    subset = vc.loadcityspelling(filename, cachefile, messages.append,
+                                 {"FR"})
+    assert sorted(subset[0].keys()) == ["FR"]
+    assert subset[2] == {"US", "FR", "DE"}
+    assert any("for 1 countries" in msg for msg in messages)
+    assert not any("could not be written" in msg for msg in messages)
+    sametables(subset[0], {"FR": ctspell["FR"]})
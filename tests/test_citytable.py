@@ -0,0 +1,84 @@
+# Exact match lookups in CityTable must find the same rows, in the same order,
+# as the linear scans over the city spelling table which they replaced
+
+import validatecities as vc
+
+# Small gazetteer with repeated names (within and across countries), names
+# which only differ once cleaned up, and names which clean up to ''
+gazetteer_rows = [
+    ("us", "springfield", "Springfield", 39.8, -89.6),
+    ("us", "springfield", "Springfield", 37.2, -93.3),
+    ("us", "st. louis", "St. Louis", 38.6, -90.2),
+    ("us", "st louis", "St Louis", 38.7, -90.3),
+    ("us", "123", "123", 1.0, 1.0),
+    ("us", "...", "...", 2.0, 2.0),
+    ("us", "(?)", "(?)", 3.0, 3.0),
+    ("us", "springfield", "Springfield", 42.1, -72.6),
+    ("fr", "paris", "Paris", 48.86, 2.35),
+    ("fr", "paris", "Paris", 45.0, 1.0),
+    ("fr", "l'isle-adam", "L'Isle-Adam", 49.1, 2.2),
+    ("fr", "l isle adam", "L Isle Adam", 49.2, 2.3),
+    ("fr", "42", "42", 4.0, 4.0),
+    ("us", "paris", "Paris", 33.7, -95.6),
+]
+
+def writegazetteer(path):
+    with open(path, "w", encoding=vc.file_encoding) as file:
+        file.write("Country,City,AccentCity,Region,Population,Latitude," +
+                   "Longitude\n")
+        for ctry, city, accent, lat, lon in gazetteer_rows:
+            file.write('{0},"{1}","{2}",01,,{3},{4}\n'.format(
+                ctry, city, accent, lat, lon))
+
+# Every row whose raw (column 0) or cleaned up (column 1) name is name, found
+# by scanning the whole table
+def linearscan(table, name, column):
+    names = table.clean if column else table.city
+    return [ii for ii in range(len(table)) if names[ii] == name]
+
+def queries(table):
+    names = set([""])
+    for ii in range(len(table)):
+        names.update([table.city[ii], table.clean[ii],
+                      table.city[ii].lower(), table.city[ii] + "X"])
+    return sorted(names)
+
+def checktables(ctspell):
+    assert sorted(ctspell.keys()) == ["FR", "US"]
+    for table in ctspell.values():
+        for name in queries(table):
+            for column in (0, 1):
+                assert table.find(name, column) == \
+                    linearscan(table, name, column), (name, column)
+
+def test_find_matches_linear_scan(tmp_path):
+    filename = str(tmp_path / "cities.txt")
+    writegazetteer(filename)
+    ctspell = vc.loadcityspelling(filename, str(tmp_path / "cities.cache"),
+                                  lambda msg: None)[0]
+    table = ctspell["US"]
+    assert table.find("SPRINGFIELD", 0) == [0, 1, 7]
+    assert table.find("ST LOUIS", 1) == [2, 3]
+    assert table.find("", 1) == [4, 5, 6]
+    checktables(ctspell)
+
+# The same again, with the tables read back from the compiled cache
+def test_find_matches_linear_scan_from_cache(tmp_path):
+    filename = str(tmp_path / "cities.txt")
+    cachefile = str(tmp_path / "cities.cache")
+    writegazetteer(filename)
+    vc.loadcityspelling(filename, cachefile, lambda msg: None)
+    messages = []
+    ctspell = vc.loadcityspelling(filename, cachefile, messages.append)[0]
+    assert "compiled cache" in messages[0]
+    checktables(ctspell)
+
+# With a hash function which makes most names collide, find() has to tell the
+# names with equal hash values apart
+def test_find_with_hash_collisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(vc, "namehash", lambda name: len(name) % 3)
+    filename = str(tmp_path / "cities.txt")
+    writegazetteer(filename)
+    ctspell = vc.loadcityspelling(filename, str(tmp_path / "cities.cache"),
+                                  lambda msg: None)[0]
+    checktables(ctspell)
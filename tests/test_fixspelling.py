@@ -0,0 +1,157 @@
+# fixspelling() with longestmatch() and bound-based pruning must choose
+# exactly the same candidates as the original difflib-based version, with or
+# without the blocking index
+
+import difflib
+import random
+import re
+
+import benchmark
+import validatecities as vc
+
+# The original fixspelling(), as it was before longestmatch(), minus its
+# statistics (stage one hasn't changed, so it's shared)
+def oldfixspelling(badcity, candidates, blocks=None):
+    if len(badcity) == 0:
+        return []
+    if blocks is not None:
+        idx = vc.screencandidates(badcity, candidates, blocks)
+    else:
+        idx = []
+        ctytoken = badcity.split()
+        for ii in range(len(candidates)):
+            cndtoken = candidates[ii].split()
+            matched = False
+            for ij in ctytoken:
+                if len(ij) > 2:
+                    for ik in cndtoken:
+                        if len(ik) > 2 and ij == ik:
+                            matched = True
+            if matched:
+                idx.append(ii)
+                continue
+            if vc.lettersincommon(badcity, candidates[ii]):
+                idx.append(ii)
+    minfrac = 1
+    city = []
+    cand = []
+    totlen = []
+    mididx = []
+    for ii in idx:
+        city.append(re.sub(' +', '', badcity))
+        cand.append(re.sub(' +', '', candidates[ii]))
+        totlen.append(len(city[-1]) + len(cand[-1]))
+        sm = difflib.SequenceMatcher(None, city[-1], cand[-1])
+        match = sm.find_longest_match(0, len(city[-1]), 0, len(cand[-1]))
+        city[-1] = vc.breakstring(city[-1], match.a, match.size)
+        cand[-1] = vc.breakstring(cand[-1], match.b, match.size)
+        newcty = []
+        newcnd = []
+        for ij in range(len(city[-1])):
+            sm = difflib.SequenceMatcher(None, city[-1][ij], cand[-1][ij])
+            match = sm.find_longest_match(0, len(city[-1][ij]), 0,
+                                          len(cand[-1][ij]))
+            newcty.extend(vc.breakstring(city[-1][ij], match.a, match.size))
+            newcnd.extend(vc.breakstring(cand[-1][ij], match.b, match.size))
+        city[-1] = "".join(newcty)
+        cand[-1] = "".join(newcnd)
+        frac = float(len(city[-1]) + len(cand[-1]))/totlen[-1]
+        if frac < minfrac:
+            for ij in range(len(city)-1):
+                city.pop(0)
+                cand.pop(0)
+                totlen.pop(0)
+            mididx = [ii]
+            minfrac = frac
+        elif frac == minfrac:
+            mididx.append(ii)
+        else:
+            city.pop(-1)
+            cand.pop(-1)
+            totlen.pop(-1)
+    finalidx = []
+    minfrac = 1
+    for ii in range(len(mididx)):
+        sm = difflib.SequenceMatcher(None, city[ii], cand[ii])
+        match = sm.find_longest_match(0, len(city[ii]), 0, len(cand[ii]))
+        while match.size > 0:
+            city[ii] = city[ii].replace(city[ii][match.a:(match.a +
+                                                          match.size)], '')
+            cand[ii] = cand[ii].replace(cand[ii][match.b:(match.b +
+                                                          match.size)], '')
+            sm = difflib.SequenceMatcher(None, city[ii], cand[ii])
+            match = sm.find_longest_match(0, len(city[ii]), 0, len(cand[ii]))
+        frac = float(len(city[ii]) + len(cand[ii]))/totlen[ii]
+        if frac < minfrac:
+            finalidx = [mididx[ii]]
+            minfrac = frac
+        elif frac == minfrac:
+            finalidx.append(mididx[ii])
+    return finalidx
+
+# A made up country's worth of cleaned up candidate names (with repeats, as
+# in the real gazetteer), and misspellings of some of them: typos,
+# transpositions, several errors at once, and names made up from scratch
+def typocorpus(seed, ncandidates, nqueries):
+    rng = random.Random(seed)
+    names = [vc.cleanup(benchmark.cityname(rng)) for ii in range(ncandidates)]
+    candidates = names + [rng.choice(names) for ii in range(ncandidates//10)]
+    rng.shuffle(candidates)
+    queries = []
+    for ii in range(nqueries):
+        name = rng.choice(names)
+        r = rng.random()
+        if r < 0.35:
+            name = benchmark.typo(rng, name)
+        elif r < 0.6:
+            name = benchmark.transpose(rng, name)
+        elif r < 0.8:
+            name = benchmark.typo(rng, benchmark.transpose(rng, name))
+        else:
+            name = benchmark.cityname(rng)
+        queries.append(vc.cleanup(name))
+    return candidates, queries
+
+def test_fixspelling_matches_difflib_version_with_blocking():
+    candidates, queries = typocorpus(16, 3000, 3000)
+    blocks = vc.blockcities(candidates)
+    for badcity in queries:
+        assert vc.fixspelling(badcity, candidates, blocks) == \
+            oldfixspelling(badcity, candidates, blocks), badcity
+
+def test_fixspelling_matches_difflib_version_without_blocking():
+    candidates, queries = typocorpus(61, 1500, 400)
+    for badcity in queries:
+        assert vc.fixspelling(badcity, candidates) == \
+            oldfixspelling(badcity, candidates), badcity
+
+def test_fixspelling_fills_in_statistics():
+    candidates, queries = typocorpus(7, 500, 50)
+    blocks = vc.blockcities(candidates)
+    for badcity in queries:
+        stats = [0]*6
+        vc.fixspelling(badcity, candidates, blocks, stats)
+        assert all(value >= 0 for value in stats)
+        assert stats[1] <= 3*stats[0]
+
+def difflibmatch(a, b):
+    match = difflib.SequenceMatcher(None, a, b).find_longest_match(
+        0, len(a), 0, len(b))
+    return match.a, match.b, match.size
+
+def test_longestmatch_matches_difflib():
+    rng = random.Random(279)
+    for ii in range(100000):
+        alphabet = "ABCDE"[:rng.randint(1, 5)]
+        a = "".join(rng.choice(alphabet) for ij in range(rng.randint(0, 14)))
+        b = "".join(rng.choice(alphabet) for ij in range(rng.randint(0, 14)))
+        assert vc.longestmatch(a, b) == difflibmatch(a, b), (a, b)
+
+# Long enough for difflib's autojunk heuristic, which longestmatch() has to
+# reproduce
+def test_longestmatch_matches_difflib_on_long_strings():
+    rng = random.Random(297)
+    for ii in range(500):
+        a = "".join(rng.choice("AB") for ij in range(rng.randint(150, 260)))
+        b = "".join(rng.choice("AB") for ij in range(rng.randint(150, 260)))
+        assert vc.longestmatch(a, b) == difflibmatch(a, b)
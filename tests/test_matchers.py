@@ -0,0 +1,112 @@
+# The SymSpell and BK-tree matching engines must find exactly the names that
+# a brute force search finds: every name at the smallest edit distance from
+# the misspelled word, if that's within the bound, in index order.  For
+# SymSpellIndex this includes words and names much longer than the prefix
+# whose deletions are indexed, with edits on either side of the prefix
+
+import random
+
+import pytest
+
+import matchers
+
+# Edit distance by the textbook dynamic programming recurrence, with no
+# bound: Levenshtein distance, or the optimal string alignment distance if
+# transpositions is set
+def distance(a, b, transpositions):
+    table = [[ii + ij if ii == 0 or ij == 0 else 0
+              for ij in range(len(b) + 1)] for ii in range(len(a) + 1)]
+    for ii in range(1, len(a) + 1):
+        for ij in range(1, len(b) + 1):
+            table[ii][ij] = min(table[ii-1][ij] + 1, table[ii][ij-1] + 1,
+                                table[ii-1][ij-1] + (a[ii-1] != b[ij-1]))
+            if transpositions and ii > 1 and ij > 1 and \
+               a[ii-1] == b[ij-2] and a[ii-2] == b[ij-1]:
+                table[ii][ij] = min(table[ii][ij], table[ii-2][ij-2] + 1)
+    return table[len(a)][len(b)]
+
+def bruteforce(names, word, maxdistance, transpositions):
+    if len(word) == 0:
+        return []
+    distances = [distance(word, name, transpositions) for name in names]
+    best = min(distances + [maxdistance + 1])
+    if best > maxdistance:
+        return []
+    return [name for name, d in zip(names, distances) if d == best]
+
+alphabet = "ABCDE S"
+
+def randomname(rng, length):
+    return "".join(rng.choice(alphabet) for ii in range(length)).strip()
+
+# Misspell a name with a few random edits anywhere in it
+def misspell(rng, name, nedits):
+    word = list(name)
+    for ii in range(nedits):
+        kind = rng.randrange(4)
+        pos = rng.randrange(len(word) + 1)
+        if kind == 0 or len(word) == 0:
+            word.insert(pos, rng.choice(alphabet))
+        elif kind == 1:
+            del word[min(pos, len(word) - 1)]
+        elif kind == 2:
+            word[min(pos, len(word) - 1)] = rng.choice(alphabet)
+        elif len(word) > 1:
+            pos = min(pos, len(word) - 2)
+            word[pos], word[pos+1] = word[pos+1], word[pos]
+    return "".join(word)
+
+def randomnames(rng, n):
+    names = set()
+    while len(names) < n:
+        # Mostly short names, but some much longer than the prefix
+        names.add(randomname(rng, rng.choice([3, 5, 6, 7, 8, 9, 12, 20])))
+    return sorted(names)
+
+@pytest.mark.parametrize("engine, transpositions",
+                         [(matchers.SymSpellIndex, True),
+                          (matchers.BKTree, False)])
+@pytest.mark.parametrize("maxdistance", [1, 2, 3])
+def test_engine_matches_brute_force(engine, transpositions, maxdistance):
+    rng = random.Random(maxdistance)
+    names = randomnames(rng, 150)
+    index = engine(names, maxdistance)
+    for ii in range(150):
+        name = rng.choice(names)
+        word = misspell(rng, name, rng.randint(0, maxdistance + 1))
+        assert index.lookup(word) == \
+               bruteforce(names, word, maxdistance, transpositions), \
+               (name, word)
+
+def test_symspell_short_prefix_misses_nothing():
+    rng = random.Random(7)
+    names = randomnames(rng, 100)
+    for prefixlength in [1, 2, 4]:
+        index = matchers.SymSpellIndex(names, 2, prefixlength)
+        for ii in range(100):
+            word = misspell(rng, rng.choice(names), rng.randint(0, 3))
+            assert index.lookup(word) == bruteforce(names, word, 2, True), \
+                   (prefixlength, word)
+
+def test_edits_at_the_prefix_boundary():
+    names = ["ABCDEFGHIJ", "ABCDEFGXYZ", "XBCDEFGHIJ"]
+    index = matchers.SymSpellIndex(names, 2)
+    for word in ["ABCDEFHGIJ", "ABCDEFGGHIJ", "ABCDEFHIJ", "XYABCDEFGHIJ",
+                 "BCDEFGHIJ", "ABCDEFGHIJKL", "BACDEFGHJI"]:
+        assert index.lookup(word) == bruteforce(names, word, 2, True), word
+
+def test_editdistance_with_bound():
+    rng = random.Random(3)
+    for ii in range(2000):
+        a = randomname(rng, rng.randint(0, 9))
+        b = misspell(rng, a, rng.randint(0, 4))
+        for transpositions in [True, False]:
+            d = distance(a, b, transpositions)
+            for bound in range(5):
+                assert matchers.editdistance(a, b, bound, transpositions) == \
+                       min(d, bound + 1), (a, b, bound)
+
+def test_empty_word_and_no_names():
+    for engine in [matchers.SymSpellIndex, matchers.BKTree]:
+        assert engine(["PARIS"]).lookup("") == []
+        assert engine([]).lookup("PARIS") == []
@@ -0,0 +1,50 @@
+# The slowest inputs kept by Metrics: each (city, country) pair is listed at
+# most once, with its slowest time, whether it's validated again in the same
+# process (as in --serve mode) or in several worker processes
+
+import re
+
+from metrics import Metrics
+
+def test_repeated_input_is_kept_once_with_its_slowest_time():
+    stats = Metrics(3)
+    for seconds in [0.2, 0.5, 0.1]:
+        stats.observe(("PARIS", "FR", 1), seconds)
+    stats.observe(("LYON", "FR", 1), 0.3)
+    assert sorted(stats.slowest, reverse=True) == \
+           [(0.5, "PARIS", "FR", 1), (0.3, "LYON", "FR", 1)]
+
+def test_slowest_inputs_are_the_slowest_distinct_pairs():
+    stats = Metrics(2)
+    for seconds, city in [(0.1, "A"), (0.4, "B"), (0.2, "A"), (0.3, "C"),
+                          (0.5, "A"), (0.05, "B"), (0.35, "C")]:
+        stats.observe((city, "US", 7), seconds)
+    assert sorted(stats.slowest, reverse=True) == \
+           [(0.5, "A", "US", 7), (0.4, "B", "US", 7)]
+
+def test_merge_keeps_one_entry_per_pair():
+    workers = [Metrics(5), Metrics(5)]
+    workers[0].observe(("PARIS", "FR", 1), 0.2)
+    workers[1].observe(("PARIS", "FR", 1), 0.4)
+    workers[1].observe(("PARIS", "US", 3), 0.1)
+    stats = Metrics(5)
+    for worker in workers:
+        stats.merge(worker)
+    assert sorted(stats.slowest, reverse=True) == \
+           [(0.4, "PARIS", "FR", 1), (0.1, "PARIS", "US", 3)]
+
+def test_prometheus_has_no_duplicate_samples():
+    stats = Metrics()
+    for ii in range(3):
+        stats.observe(("PARIS", "FR", 1), 0.1*(ii + 1))
+    samples = [line.rsplit(" ", 1)[0] for line in
+               stats.prometheus().splitlines() if not line.startswith("#")]
+    assert len(samples) == len(set(samples))
+    assert len([sample for sample in samples if
+                re.match("validatecities_slowest_input_seconds", sample)]) == 1
+
+def test_no_slowest_inputs():
+    stats = Metrics(0)
+    stats.observe(("PARIS", "FR", 1), 0.1)
+    stats.merge(stats)
+    assert stats.slowest == []
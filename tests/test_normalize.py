@@ -0,0 +1,86 @@
+# normalize() must give exactly the same results as the original cleanup()
+# routine which it replaced, as Python 2 ran it, on any input
+
+import random
+import re
+
+import normalize
+
+# The original cleanup(), as it was before normalize.py, run the way Python 2
+# ran it: on the raw bytes of the name, where upper() changes only the ASCII
+# letters and strip() removes only ASCII whitespace
+def oldcleanup(s):
+    cls = s.encode("latin-1").upper()
+    cls = cls.replace(b'-', b' ')
+    cls = cls.replace(b'.', b' ')
+    cls = cls.replace(b',', b' ')
+    cls = cls.replace(b'/', b' ')
+    cls = cls.replace(b'(', b'')
+    cls = cls.replace(b')', b'')
+    cls = cls.replace(b'\\', b'')
+    cls = cls.replace(b'"', b'')
+    cls = cls.replace(b'?', b'')
+    cls = cls.replace(b"'S", b"S")
+    cls = cls.replace(b"'", b" ")
+    cls = cls.replace(b"`", b" ")
+    leadnum = re.findall(b'^[0-9]+', cls)
+    if len(leadnum) == 0: # Usual case: string does not start with a number
+        cls = re.sub(b'[0-9]+', b'', cls)
+    else: # Less common: string *does* start with a number
+        trail = re.sub(b'[0-9]+', b'', cls)
+        # If there are alphabetic characters, use the leading number plus those
+        if any([c in trail for c in b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"]):
+            cls = leadnum[0] + re.sub(b'[0-9]+', b'', cls)
+        # If the string consists of *only* numeric characters, null it out
+        else:
+            cls = b''
+    cls = re.sub(b' +', b' ', cls)
+    cls = cls.rstrip().lstrip()
+    return cls.decode("latin-1")
+
+# Pieces which random names are made of: letters (upper and lower case, and
+# non-ASCII), every character that the rules treat specially, "'S" and "'s",
+# digits, and various kinds of whitespace
+pieces = (list("ABCXYZabcxyz") + list("-.,/()\\\"?'`") + ["'S", "'s", "'S'"] +
+          list("0123456789") + ["12", "007"] + list("ÉéÖößÿµ") +
+          [" ", "  ", "\t", "\n", "\xa0", "\x85", "\x1f"])
+
+def randomnames(rng, n):
+    for ii in range(n):
+        yield "".join(rng.choice(pieces) for ij in range(rng.randint(0, 12)))
+
+def test_normalize_matches_old_cleanup():
+    rng = random.Random(20130629)
+    for name in randomnames(rng, 100000):
+        assert normalize.normalize(name) == oldcleanup(name), repr(name)
+
+def test_normalize_real_style_names():
+    names = ["ST. LOUIS", "Saint-Jean-d'Angely", "1000 Islands", "42",
+             "12 (Old Town)", "O'SULLIVAN'S CROSS", "  New   York  ", "",
+             "?", "Köln/Deutz", "'S-HERTOGENBOSCH", "(S)T. Peter", "9 - 5",
+             "Rue (1er)", "A'(S)B"]
+    for name in names:
+        assert normalize.normalize(name) == oldcleanup(name), repr(name)
+
+def test_normalize_leaves_non_ascii_letters_alone():
+    assert normalize.normalize("straße") == "STRAßE"
+    assert normalize.normalize("Hayÿ") == "HAYÿ"
+    assert normalize.normalize("µ-Town") == "µ TOWN"
+    assert normalize.normalize("\xa0Köln\xa0") == "\xa0KöLN\xa0"
+    for name in ["STRAßE", "straße", "HAYÿ", "µ", "ÿ µ"]:
+        assert normalize.normalize(name) == oldcleanup(name), repr(name)
+    # Every result can still be written out in the files' encoding
+    for code in range(256):
+        normalize.normalize(chr(code)).encode("latin-1")
+    assert normalize.upper("ßÿµéz") == "ßÿµéZ"
+
+def test_normalize_many_matches_normalize():
+    rng = random.Random(1)
+    names = list(randomnames(rng, 2000))
+    names = names + names[::3] # Repeat some of them
+    expected = [normalize.normalize(name) for name in names]
+    assert normalize.normalize_many(names) == expected
+    memo = {}
+    assert normalize.normalize_many(names, memo) == expected
+    assert normalize.normalize_many(names, memo) == expected
+    assert len(memo) == len(set(names))
@@ -0,0 +1,35 @@
+# Both output files must come out byte for byte the same as those of the
+# original Python 2 script, which produced the files in tests/data/small from
+# the small set of reference and input files in conftest.py
+
+import os
+
+import pytest
+
+import validatecities as vc
+
+golden = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                      "small")
+
+def readbytes(filename):
+    with open(filename, "rb") as file:
+        return file.read()
+
+@pytest.mark.parametrize("options", [[], ["--workers", "2"], ["--load-all"],
+                                     ["--streaming", "--memory-budget", "1"]])
+def test_output_matches_original_script(smallrun, runscript, options):
+    runscript(smallrun, *options)
+    for filename in [vc.processed_file, vc.unique_file]:
+        assert readbytes(str(smallrun / filename)) == \
+               readbytes(os.path.join(golden, filename)), filename
+
+def test_formatcoord_matches_python2_str():
+    assert vc.formatcoord(78.94686250000001) == "78.9468625"
+    assert vc.formatcoord(0.15000000000000002) == "0.15"
+    assert vc.formatcoord(43.2965234567891) == "43.2965234568"
+    assert vc.formatcoord(50.0) == "50.0"
+    assert vc.formatcoord(-1e-05) == "-1e-05"
+    assert vc.formatcoord(1e16) == "1e+16"
+    assert vc.formatcoord(99999999999.0) == "99999999999.0"
+    assert vc.formatcoord(123456789012.0) == "1.23456789012e+11"
+    assert vc.formatcoord('') == ''
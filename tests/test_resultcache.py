@@ -0,0 +1,42 @@
+# Compacting the result cache removes the results made with other reference
+# data or matching code, but keeps the current version's results for every
+# matching engine
+
+import validatecities as vc
+
+def store(filename, version, cities):
+    cache = vc.openresultcache(filename, version)
+    vc.storeresults(cache, [vc.ValidationResult(city, "FR", 1, city, city,
+                                                "France", 1.0, 2.0)
+                            for city in cities])
+    cache[0].close()
+
+def versions(filename):
+    cache = vc.openresultcache(filename, "")
+    found = cache[0].execute("SELECT version, COUNT(*) FROM results " +
+                             "GROUP BY version ORDER BY version").fetchall()
+    cache[0].close()
+    return found
+
+def test_compaction_keeps_other_matchers(tmp_path):
+    filename = str(tmp_path / "results.db")
+    store(filename, "old/difflib/2", ["A", "B"])
+    store(filename, "new/difflib/2", ["A", "B", "C"])
+    store(filename, "new/symspell/2", ["A"])
+    store(filename, "new/bktree/1", ["B"])
+    cache = vc.openresultcache(filename, "new/symspell/2")
+    assert vc.compactresultcache(cache) == 2
+    cache[0].close()
+    assert versions(filename) == [("new/bktree/1", 1), ("new/difflib/2", 3),
+                                  ("new/symspell/2", 1)]
+
+def test_result_version_depends_on_matcher_settings(tmp_path):
+    airports = tmp_path / "airports.dat"
+    airports.write_text("", encoding=vc.file_encoding)
+    fprint = {"sha1": "0", "cleanup": "0"}
+    version = lambda matcher, maxdistance: vc.resultversion(
+        fprint, str(airports), {}, {}, matcher, maxdistance)
+    assert version("difflib", 2).endswith("/difflib/2")
+    assert version("symspell", 1).endswith("/symspell/1")
+    assert version("difflib", 2).split("/")[0] == \
+        version("symspell", 1).split("/")[0]
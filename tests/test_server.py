@@ -0,0 +1,55 @@
+# The --serve mode HTTP interface, run in a thread against a Validator loaded
+# from a tiny set of reference files
+
+import json
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+import validatecities as vc
+
+@pytest.fixture
+def server(tmp_path):
+    countrymap = tmp_path / "countrymap.txt"
+    countrymap.write_text("FR|France\nUS|United States\n",
+                          encoding=vc.file_encoding)
+    cities = tmp_path / "cities.txt"
+    cities.write_text("Country,City,AccentCity,Region,Population,Latitude," +
+                      "Longitude\nfr,paris,Paris,A8,,48.86,2.35\n" +
+                      "us,paris,Paris,TX,,33.66,-95.55\n",
+                      encoding=vc.file_encoding)
+    airports = tmp_path / "airports.dat"
+    airports.write_text('1,"Paris Airport","Paris","France","CDG","LFPG",' +
+                        '49.0,2.5,392,1,"E"\n', encoding=vc.file_encoding)
+    validator = vc.Validator(str(countrymap), str(cities), str(airports),
+                             str(tmp_path / "cities.cache"), verbose=False)
+    server = vc.ValidationServer(("127.0.0.1", 0), validator)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def post(server, body):
+    connection = HTTPConnection(*server.server_address[:2])
+    connection.request("POST", "/validate", body)
+    response = connection.getresponse()
+    result = (response.status, json.loads(response.read().decode("utf-8")))
+    connection.close()
+    return result
+
+def test_post_validates_pairs(server):
+    status, body = post(server, json.dumps([["PARIS", "FR"], ["PARIS", "DE"]]))
+    assert status == 200
+    assert [v["quality"] for v in body["results"]] == [1, 9]
+
+@pytest.mark.parametrize("body", ['{"AB": 1}', '"AB"', '["AB"]',
+                                  '[["PARIS", "FR", "X"]]', '[["PARIS"]]',
+                                  '[["PARIS", 1]]', '[[null, "FR"]]',
+                                  '[{"PARIS": "FR"}]', 'not json'])
+def test_post_rejects_anything_but_pairs_of_strings(server, body):
+    status, reply = post(server, body)
+    assert status == 400
+    assert "error" in reply
@@ -0,0 +1,60 @@
+# Splitting the input into country shards with --shard, running each shard as
+# a separate process with --run-shard, and putting their output back together
+# with --merge must give the same output files as validating the whole input
+# file in a single run
+
+import os
+import shutil
+
+import pytest
+
+import validatecities as vc
+
+def readbytes(filename):
+    with open(filename, "rb") as file:
+        return file.read()
+
+def singlerun(dirname, runscript):
+    single = dirname / "single"
+    single.mkdir()
+    for filename in [vc.countrymap_file, vc.cityspelling_file,
+                     vc.airports_file, vc.unvalid_file]:
+        shutil.copy(str(dirname / filename), str(single / filename))
+    runscript(single)
+    return single
+
+@pytest.mark.parametrize("nshards", [1, 2, 3])
+def test_sharded_run_matches_single_run(smallrun, runscript, nshards):
+    single = singlerun(smallrun, runscript)
+    runscript(smallrun, "--shard", str(nshards))
+    for k in range(nshards):
+        runscript(smallrun, "--run-shard", str(k))
+    runscript(smallrun, "--merge")
+    for filename in [vc.processed_file, vc.unique_file]:
+        assert readbytes(str(smallrun / filename)) == \
+               readbytes(str(single / filename)), filename
+
+def test_merge_before_every_shard_has_run(smallrun, runscript):
+    runscript(smallrun, "--shard", "2")
+    runscript(smallrun, "--run-shard", "1")
+    result = runscript(smallrun, "--merge", check=False)
+    output = result.stdout.decode("latin-1")
+    assert result.returncode == 2
+    assert "--run-shard 0 before --merge" in output
+    assert "Traceback" not in output
+    assert not os.path.exists(str(smallrun / vc.processed_file))
+
+def test_merge_with_a_shard_cut_short(smallrun, runscript):
+    runscript(smallrun, "--shard", "2")
+    for k in range(2):
+        runscript(smallrun, "--run-shard", str(k))
+    processed = vc.shardfile(str(smallrun / "shards"), 0, vc.processed_file)
+    with open(processed, "rb") as file:
+        lines = file.readlines()
+    with open(processed, "wb") as file:
+        file.writelines(lines[:-1])
+    result = runscript(smallrun, "--merge", check=False)
+    output = result.stdout.decode("latin-1")
+    assert result.returncode == 2
+    assert "Output of shard 0 is missing some lines" in output
+    assert "Traceback" not in output
@@ -0,0 +1,90 @@
+# --streaming mode must write exactly the same output files as the default
+# mode, including when it has more unique cities than fit in its memory
+# budget, so that the first pass spills them to disk several times and the
+# second pass has to keep discarding the results it holds in memory
+
+import random
+
+import pytest
+
+import validatecities as vc
+
+syllables = ["KA", "LO", "MI", "NE", "RI", "TON", "VILLE", "BURG", "OV", "SK"]
+
+def cityname(rng):
+    return "".join(rng.choice(syllables) for ii in range(rng.randint(2, 4)))
+
+# Reference and input files with several thousand unique cities in the
+# input (--memory-budget 1 holds about 1300), most of them exact matches or
+# unknown countries, so that they're quick to validate
+@pytest.fixture
+def largerun(tmp_path):
+    rng = random.Random(6)
+    codes = ["DK", "FR", "US"]
+    countries = ["Denmark", "France", "United States"]
+    names = {code: sorted(set(cityname(rng) for ii in range(700)))
+             for code in codes}
+    with open(str(tmp_path / vc.countrymap_file), "w",
+              encoding=vc.file_encoding) as file:
+        for code, country in zip(codes, countries):
+            file.write(code + "|" + country + "\n")
+    with open(str(tmp_path / vc.cityspelling_file), "w",
+              encoding=vc.file_encoding) as file:
+        file.write("Country,City,AccentCity,Region,Population,Latitude," +
+                   "Longitude\n")
+        for code in codes:
+            for name in names[code]:
+                for region in range(rng.choice([1, 1, 1, 2])):
+                    file.write("{0},{1},{2},{3:02d},,{4},{5}\n".format(
+                        code.lower(), name.lower(), name.title(), region,
+                        rng.uniform(-80, 80), rng.uniform(-170, 170)))
+    # Every country needs at least one airport, and some cities have two
+    with open(str(tmp_path / vc.airports_file), "w",
+              encoding=vc.file_encoding) as file:
+        apid = 1
+        for code, country in zip(codes, countries):
+            for name in names[code][::5]:
+                for ii in range(rng.randint(1, 2)):
+                    file.write('{0},"{1} Airport","{1}","{2}",'.format(
+                               apid, name.title(), country) +
+                               '"ABC","ABCD",{0},{1},100,1,"E"\n'.format(
+                               rng.uniform(-80, 80), rng.uniform(-170, 170)))
+                    apid = apid + 1
+    lines = []
+    for ii in range(6000):
+        r = rng.random()
+        code = rng.choice(codes)
+        if r < 0.5:
+            lines.append((rng.choice(names[code]), code))
+        elif r < 0.6:
+            lines.append((rng.choice(names[code]).lower() + ".", code))
+        elif r < 0.61:
+            lines.append((rng.choice(names[code])[1:] + "A", code))
+        else:
+            lines.append((cityname(rng) + str(ii), "X" + code[0]))
+    lines = lines + rng.sample(lines, 2000)
+    rng.shuffle(lines)
+    with open(str(tmp_path / vc.unvalid_file), "w",
+              encoding=vc.file_encoding) as file:
+        file.write("City|Country\n")
+        for city, ctry in lines:
+            file.write("{0}|{1}\n".format(city, ctry))
+    return tmp_path
+
+def readbytes(filename):
+    with open(filename, "rb") as file:
+        return file.read()
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_streaming_with_spilling_matches_default_mode(largerun, runscript,
+                                                      workers):
+    runscript(largerun)
+    expected = [readbytes(str(largerun / filename)) for filename in
+                [vc.processed_file, vc.unique_file]]
+    # More unique cities than --memory-budget 1 keeps in memory at once
+    maxpairs = 1024*1024//2//vc.streaming_pair_bytes
+    assert expected[1].count(b"\n") - 1 > 3*maxpairs
+    runscript(largerun, "--streaming", "--memory-budget", "1", "--workers",
+              workers)
+    assert readbytes(str(largerun / vc.processed_file)) == expected[0]
+    assert readbytes(str(largerun / vc.unique_file)) == expected[1]
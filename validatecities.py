@@ -8,13 +8,22 @@ The script sequence structure is summarized in the following logical outline:
     headers, etc.
     
     (II) Definition of Functions: create some routines to help deal with text
-    handling, especially garbled or off-nominal spellings.
+    handling, especially garbled or off-nominal spellings.  The rules for
+    cleaning up city names are implemented separately, in normalize.py.
     
     (III) Read in Country Map File: creates Python dictionary with country
     code to country name mapping, plus an inverse mapping as well.
 
     (IV) Read in City Spelling File: creates a large master lookup table with
-    around 3 million place names to aid in city name validation.
+    around 3 million place names to aid in city name validation, plus a hash
+    index into that table for fast lookup of exact name matches.  Unless
+    --load-all is given, the input file is scanned first, and only the
+    countries which it has cities in are loaded here (and in part V); any
+    other country is loaded the first time that it's needed (if there's no
+    up to date compiled cache, the whole file is still parsed once in order
+    to compile one, and those countries are then read back from it).  The
+    file can be read still gzipped, or (with --workers) split up and parsed
+    by several processes at once.
     
     (V) Read in Airport Spelling File: creates a smaller lookup table with
     names of cities that are large enough to have airports, to aid in 
@@ -24,23 +33,75 @@ The script sequence structure is summarized in the following logical outline:
     and prominence).
     
     (VI) Process Input File: attempts to validate city names, using resources
-    generated in parts II through V.
+    generated in parts II through V.  Optionally (--streaming), this is done
+    in two passes over the input file, with the unique city names kept on
+    disk, so that memory use doesn't grow with the size of the input.
     
     (VII) Generate Unique Cities File: generates a sorted list of unique input
     cities with their validated output names and dumps to a .csv file for
     user review.
-    
+
+Parts III through V are wrapped up in the Validator class, which can also be
+imported and used on its own, and with --serve the script keeps a Validator
+loaded and answers validation requests over HTTP (on a TCP port or a Unix
+domain socket) instead of processing the input file.
+
+Misspelled city names are corrected by fixspelling() by default, or with
+--matcher by one of the edit distance engines in matchers.py instead.
+
+With --shard, the input file is instead split up by country, so that each
+part can be validated separately (e.g., on different machines sharing a
+filesystem) with --run-shard, loading only the reference data for its own
+countries; --merge then puts the results back together exactly as a single
+run would have produced them.
+
+Metrics covering the whole run (time spent in each stage, counts of each
+quality indicator, fixspelling() histograms, the slowest inputs, etc.) are
+always collected, and can be written out with --metrics; see metrics.py.
+
 Author: Andrew L. Stachyra
 Date: 6/29/2013    
 """
 
 import sys
+import os
+import argparse
+import multiprocessing
+import sqlite3
+import tempfile
 import csv
+import gzip
+import io
 import re
+import json
+import heapq
+import mmap
+import struct
+import hashlib
+import zlib
+import time
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from bisect import bisect_left
+from array import array
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+try:
+    import numpy
+except ImportError: # NumPy is optional; it only speeds up fixspelling()
+    numpy = None
 from operator import itemgetter
+from collections import namedtuple, deque
 import difflib
 from math import floor
 import datetime
+import cProfile
+import normalize
+from metrics import Metrics
+import matchers
 
 t0 = datetime.datetime.now()
 
@@ -51,148 +112,678 @@ countrymap_file = "Problem 3 Input Data - Country Map.txt"
 cityspelling_file = "worldcitiespop.txt" # www.maxmind.com/en/worldcities
 # openflights.svn.sourceforge.net/viewvc/openflights/openflights/data/airports.dat
 airports_file = "airports.dat" # openflights.org/data.html
+# Compiled binary version of cityspelling_file; (re)generated automatically
+# whenever it is missing or out of date with respect to cityspelling_file.
+# For any other city spelling file, the compiled version is named after it.
+# The city spelling file can also be read still gzipped, as downloaded, in
+# which case the compiled version is named as if it weren't
+cityspelling_cache = "worldcitiespop.cache"
+
+# Encoding of every text file read or written.  The MaxMind file is
+# ISO-8859-1, and since that maps each byte to a character of its own, the
+# bytes of the other files pass through unchanged too (as they did when the
+# script ran on Python 2), whatever encoding they're actually in
+file_encoding = "latin-1"
 
 # Output file names
 processed_file = "processed_cities.csv"
 unique_file = "unique_cities.csv"
+# Number of new (city, country) pairs handed to each worker process at a time,
+# and the maximum number of input lines read ahead of the output file
+worker_chunk = 16
+batch_lines = 100000
+# Number of byte ranges per worker process that the city spelling file is
+# split into when it's parsed by several workers
+load_chunks = 4
+# Version number of the city name matching rules, for the result cache; this
+# should be increased whenever a change outside of the matching functions
+# themselves (see Validator.version) affects validation results
+matcher_version = 1
+# Rough estimate of the memory used by each unique city held in memory in
+# --streaming mode (a tuple of two short strings, plus its dictionary entry)
+streaming_pair_bytes = 400
 # Column header names for output files
 column_headers = "'InputCity','InputCountryAbbrev','Quality'," + \
                  "'OutputCityASCII','OutputCityAccent'," + \
                  "'OutputCountryName','Latitude','Longitude'\n"
+# Format string for each line of processed_file (see outputline)
+output_format = "'{0}','{1}',{2},'{3}','{4}','{5}',{6},{7}\n"
+# Default address for --serve mode, and the number of most recent requests
+# whose latencies are kept for its statistics
+serve_host = "127.0.0.1"
+serve_port = 8765
+serve_latencies = 10000
+
+# Command line options
+parser = argparse.ArgumentParser(description="Validate and geocode the city " +
+                                 "names in the challenge problem #3 input file")
+parser.add_argument("--input", default=unvalid_file, metavar="FILE",
+                    help="unvalidated input file (default: %(default)s)")
+parser.add_argument("--country-map", default=countrymap_file, metavar="FILE",
+                    help="country code map file (default: %(default)s)")
+parser.add_argument("--cities", default=cityspelling_file, metavar="FILE",
+                    help="city spelling file (default: %(default)s)")
+parser.add_argument("--airports", default=airports_file, metavar="FILE",
+                    help="airports file (default: %(default)s)")
+parser.add_argument("--processed", default=processed_file, metavar="FILE",
+                    help="processed cities output file (default: " +
+                    "%(default)s)")
+parser.add_argument("--unique", default=unique_file, metavar="FILE",
+                    help="unique cities output file (default: %(default)s)")
+parser.add_argument("--workers", type=int, default=1, metavar="N",
+                    help="number of worker processes to use for parsing " +
+                    "the city spelling file (unless it's gzipped) and for " +
+                    "validating city names (default: 1)")
+parser.add_argument("--streaming", action="store_true",
+                    help="validate in two passes over the input file, " +
+                    "keeping the table of unique cities on disk rather " +
+                    "than in memory, so that memory use doesn't grow with " +
+                    "the size of the input")
+parser.add_argument("--memory-budget", type=int, default=512, metavar="MB",
+                    help="approximate amount of memory used for unique " +
+                    "cities in --streaming mode, in megabytes, not " +
+                    "counting the reference data (default: 512)")
+parser.add_argument("--result-cache", metavar="FILE",
+                    help="keep validation results in this file, and reuse " +
+                    "them on later runs with the same reference data")
+parser.add_argument("--compact-result-cache", action="store_true",
+                    help="remove results for any other version of the " +
+                    "reference data or matching code from the " +
+                    "--result-cache file, and exit; results for the " +
+                    "current version are kept whichever --matcher and " +
+                    "--max-edit-distance they were made with")
+parser.add_argument("--serve", action="store_true",
+                    help="instead of processing the input file, load the " +
+                    "reference data and then answer validation requests " +
+                    "over HTTP until interrupted")
+parser.add_argument("--host", default=serve_host,
+                    help="address to listen on in --serve mode (default: " +
+                    "%(default)s)")
+parser.add_argument("--port", type=int, default=serve_port,
+                    help="port to listen on in --serve mode (default: " +
+                    "%(default)s)")
+parser.add_argument("--socket", metavar="PATH",
+                    help="in --serve mode, listen on this Unix domain " +
+                    "socket instead of a TCP port")
+parser.add_argument("--load-all", action="store_true",
+                    help="load the reference data for every country up " +
+                    "front, rather than only for the countries found in " +
+                    "the input file")
+parser.add_argument("--matcher", choices=["difflib", "symspell", "bktree"],
+                    default="difflib",
+                    help="engine for correcting misspelled city names: the " +
+                    "original difflib-based fixspelling(), or a lookup of " +
+                    "the names within --max-edit-distance edits in a " +
+                    "SymSpell-style deletion index or a BK-tree (see " +
+                    "matchers.py) (default: %(default)s)")
+parser.add_argument("--max-edit-distance", type=int,
+                    default=matchers.default_maxdistance, metavar="N",
+                    help="largest number of edits which the symspell and " +
+                    "bktree engines will correct (default: %(default)s)")
+parser.add_argument("--metrics", metavar="FILE",
+                    help="write a snapshot of the run metrics (time spent " +
+                    "in each stage, quality indicator counts, fixspelling() " +
+                    "histograms, slowest inputs, etc.) to this file " +
+                    "periodically, and at the end of the run")
+parser.add_argument("--metrics-format", choices=["json", "prometheus"],
+                    default="json",
+                    help="format of the --metrics file: JSON, or the " +
+                    "Prometheus text format (default: %(default)s)")
+parser.add_argument("--metrics-interval", type=float, default=60,
+                    metavar="SECONDS",
+                    help="minimum time between --metrics snapshots " +
+                    "(default: %(default)s)")
+parser.add_argument("--slowest", type=int, default=20, metavar="N",
+                    help="number of slowest input cities to keep in the " +
+                    "metrics (default: %(default)s)")
+parser.add_argument("--shard", type=int, metavar="N",
+                    help="split the input file into N shards by country, " +
+                    "balanced by the size of each country's reference " +
+                    "data, in subdirectories of --shard-dir, and exit")
+parser.add_argument("--run-shard", type=int, metavar="K",
+                    help="validate shard number K (counting from 0) in " +
+                    "--shard-dir, loading only the reference data for its " +
+                    "countries; its output files are written alongside its " +
+                    "part of the input file")
+parser.add_argument("--merge", action="store_true",
+                    help="put the output files of all of the shards in " +
+                    "--shard-dir back together into the --processed and " +
+                    "--unique files, exactly as if the input file had been " +
+                    "validated all at once, and exit")
+parser.add_argument("--shard-dir", default="shards", metavar="DIR",
+                    help="directory of shards for --shard, --run-shard and " +
+                    "--merge (default: %(default)s)")
+parser.add_argument("--profile", metavar="FILE",
+                    help="run under cProfile, and write the profile to this " +
+                    "file (worker processes are not included)")
 
 # Make sure that print statements to stdout are immediately flushed to screen
 def flprt(msg):
     print(msg)
     sys.stdout.flush()
 
+# Peak resident memory size of this process so far, in megabytes, or None if
+# it isn't available on this platform
+def peakmemory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # Reported in bytes rather than kilobytes
+        peak = peak // 1024
+    return peak // 1024
+
 # When common substrings are found between s and some other string, delete
 # the common substring and break s into two halves
 def breakstring(s, start, size):
     return [s[0:start], s[start+size:len(s)]]
 
+# Longest common substring of a and b, as (start in a, start in b, length).
+# Of several equally long ones, this is the one which starts earliest in a,
+# and then earliest in b, which is the same one that difflib's
+# find_longest_match() would find.  If there are none, it's (0, 0, 0).  The
+# length is found by a binary search, checking for common substrings of each
+# trial length with str's own substring search, which for short strings like
+# city names is much faster than difflib (or a dynamic programming table in
+# pure Python).  Once b is long enough for difflib's "autojunk" heuristic to
+# kick in, difflib is used instead, so that the result is always the same
+def longestmatch(a, b):
+    if len(b) >= difflib_autojunk:
+        match = difflib.SequenceMatcher(None, a, b).find_longest_match(
+            0, len(a), 0, len(b))
+        return match.a, match.b, match.size
+    lo = 0
+    hi = min(len(a), len(b))
+    while lo < hi:
+        size = (lo + hi + 1)//2
+        for ii in range(len(a) - size + 1):
+            if a[ii:ii+size] in b:
+                lo = size
+                break
+        else:
+            hi = size - 1
+    if lo > 0:
+        for ii in range(len(a) - lo + 1):
+            ij = b.find(a[ii:ii+lo])
+            if ij >= 0:
+                return ii, ij, lo
+    return 0, 0, 0
+
+# Length of the second string from which difflib.SequenceMatcher starts to
+# ignore its most common characters
+difflib_autojunk = 200
+
 # Clean up nuisance characters, extra spaces, and any numbers except for
-# leading numbers followed by some characters in the alphabet
-def cleanup(s):
-    cls = s.upper()
-    cls = cls.replace('-', ' ')
-    cls = cls.replace('.', ' ')
-    cls = cls.replace(',', ' ')
-    cls = cls.replace('/', ' ')    
-    cls = cls.replace('(', '')
-    cls = cls.replace(')', '')
-    cls = cls.replace('\\', '')
-    cls = cls.replace('"', '')
-    cls = cls.replace('?', '')
-    cls = cls.replace("'S", "S")
-    cls = cls.replace("'", " ")
-    cls = cls.replace("`", " ")
-    leadnum = re.findall('^[0-9]+', cls)
-    if len(leadnum) == 0: # Usual case: string does not start with a number
-        cls = re.sub('[0-9]+', '', cls)
-    else: # Less common: string *does* start with a number
-        trail = re.sub('[0-9]+', '', cls)
-        # If there are alphabetic characters, use the leading number plus those
-        if any([c in trail for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]):
-            cls = leadnum[0] + re.sub('[0-9]+', '', cls)
-        # If the string consists of *only* numeric characters, null it out
-        else: 
-            cls = ''
-    cls = re.sub(' +', ' ', cls)
-    cls = cls.rstrip().lstrip()
-    return cls
-
-# Attempt to fix spelling mistakes, if possible
-def fixspelling(badcity, candidates):
+# leading numbers followed by some characters in the alphabet (see
+# normalize.py for the details)
+cleanup = normalize.normalize
+
+# Sequence of strings which are all stored end to end in one long string,
+# along with an array of offsets marking where each of them starts.  This
+# takes a small fraction of the memory that a list of separate string objects
+# would need; individual strings are sliced out of the long one on demand
+class StringTable(object):
+
+    def __init__(self, text, offsets):
+        self.text = text
+        self.offsets = offsets
+
+    # Build a new table from a list of strings
+    @classmethod
+    def fromlist(cls, strings):
+        offsets = array("I", [0])
+        total = 0
+        for string in strings:
+            total = total + len(string)
+            offsets.append(total)
+        return cls("".join(strings), offsets)
+
+    # Join several tables end to end into a new one
+    @classmethod
+    def concat(cls, tables):
+        if len(tables) == 1:
+            return tables[0]
+        offsets = array("I", [0])
+        total = 0
+        for table in tables:
+            offsets.extend(array("I", [total + ii for ii in
+                                       table.offsets[1:]]))
+            total = total + table.offsets[-1]
+        return cls("".join(table.text for table in tables), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ii):
+        return self.text[self.offsets[ii]:self.offsets[ii+1]]
+
+# Hash value of a city name, as used by the exact match indices of CityTable;
+# unlike hash(), this is the same from one run to the next
+def namehash(name):
+    return zlib.crc32(name.encode("utf-8")) & 0xffffffff
+
+# Build an exact match index for a sequence of city names, consisting of two
+# arrays: the hash values of all the names in ascending order, and the row
+# index of the name with each hash value.  Rows with equal hash values are
+# kept in ascending order
+def hashindex(names):
+    hashes = [namehash(name) for name in names]
+    rows = sorted(range(len(hashes)), key=hashes.__getitem__)
+    return [array("I", [hashes[ik] for ik in rows]), array("I", rows)]
+
+# Combine the exact match indices of several consecutive runs of names (with
+# sizes giving the number of names in each) into the index of all of them, as
+# though hashindex had been called on the whole sequence.  Each hash value
+# and row index are packed into a single integer, so that sorting those puts
+# rows with equal hash values in ascending order, and the sort itself only
+# has to merge the already sorted runs
+def mergeindex(indices, sizes):
+    if len(indices) == 1:
+        return indices[0]
+    packed = []
+    base = 0
+    for (hashes, rows), size in zip(indices, sizes):
+        packed.extend([(hashes[ik] << 32) | (rows[ik] + base) for ik in
+                       range(len(rows))])
+        base = base + size
+    packed.sort()
+    return [array("I", [value >> 32 for value in packed]),
+            array("I", [value & 0xffffffff for value in packed])]
+
+# Columnar table of the city spelling entries for one country, in file order:
+# the raw (upper case), cleaned up, and accented city names as StringTables,
+# plus the latitudes and longitudes as arrays of floats.  The raw and cleaned
+# up names also each have an exact match index (see hashindex), which is built
+# if it isn't provided
+class CityTable(object):
+
+    def __init__(self, city, clean, accent, lat, lon, index=None):
+        self.city = city
+        self.clean = clean
+        self.accent = accent
+        self.lat = lat
+        self.lon = lon
+        if index is None:
+            index = [hashindex(city), hashindex(clean)]
+        self.index = index
+
+    def __len__(self):
+        return len(self.lat)
+
+    # Find all rows whose raw (column 0) or cleaned up (column 1) city name
+    # is exactly equal to name, in ascending order, so that the first one is
+    # the same match that a linear scan would find first
+    def find(self, name, column):
+        hashes, rows = self.index[column]
+        names = self.clean if column else self.city
+        value = namehash(name)
+        ii = bisect_left(hashes, value)
+        found = []
+        while ii < len(hashes) and hashes[ii] == value:
+            if names[rows[ii]] == name:
+                found.append(rows[ii])
+            ii = ii + 1
+        return found
+
+# Add the bytecode and constants of a compiled function body to a hash,
+# including any nested code objects (e.g., list comprehensions), whose repr
+# would otherwise contain a memory address which changes from run to run
+def hashcode(code, sha1):
+    sha1.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            hashcode(const, sha1)
+        else:
+            sha1.update(repr(const).encode("utf-8"))
+
+# Identify the exact contents of the city spelling file, plus the version of
+# the cleanup() rules which were applied to it and the encoding it was read
+# with, so that a compiled cache file can be recognized as stale when any of
+# them changes
+def fingerprint(filename):
+    stat = os.stat(filename)
+    rules = hashlib.sha1()
+    hashcode(normalize.normalize.__code__, rules)
+    rules.update(repr(normalize.rules).encode("utf-8"))
+    return {"size": stat.st_size, "mtime": stat.st_mtime,
+            "sha1": filehash(filename), "cleanup": rules.hexdigest(),
+            "byteorder": sys.byteorder, "format": cache_format,
+            "encoding": file_encoding}
+
+# Compute the SHA-1 hash of the contents of a file
+def filehash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# Bit reserved in the character masks of city names (see charmask) for any
+# characters which don't have a bit of their own
+overflow_bit = 1 << 63
+# Number of bits set in each possible byte value
+if numpy is not None:
+    popcount_table = numpy.array([bin(ii).count("1") for ii in range(256)],
+                                 dtype=numpy.uint8)
+
+# Layout of the compiled city spelling cache file: a fixed size preamble
+# containing a magic string and the length of a JSON header, followed by the
+# JSON header itself (file fingerprint plus a directory of countries), and then
+# the contents of each country's CityTable as a series of data blocks, each of
+# which starts on an 8 byte boundary: latitudes and longitudes as packed
+# float64 arrays; raw, cleaned up, and accented city names, each as an array
+# of offsets plus the UTF-8 text of the names; and the hashes and rows of the
+# two exact match indices
+cache_magic = b"VCITIES\0"
+cache_format = 2
+cache_preamble = struct.Struct("<8sQ")
+
+# Write the contents of ctspell to a compiled cache file.  The data is first
+# written to a temporary file which then replaces the cache file in a single
+# step, so that an interrupted run never leaves a truncated cache behind
+def writecache(filename, ctspell, fprint):
+    blocks = []
+    directory = []
+    offset = 0
+    for ctry in ctspell.keys():
+        table = ctspell[ctry]
+        data = [table.lat, table.lon]
+        for names in (table.city, table.clean, table.accent):
+            data.extend([names.offsets, names.text.encode("utf-8")])
+        data.extend(table.index[0] + table.index[1])
+        directory.append([ctry, len(table), offset, []])
+        for block in data:
+            block = memoryview(block).cast("B")
+            padding = -len(block) % 8
+            blocks.extend([block, b"\0"*padding])
+            directory[-1][3].append(len(block))
+            offset = offset + len(block) + padding
+    header = json.dumps({"fingerprint": fprint,
+                         "countries": directory}).encode("utf-8")
+    header = header + b" "*(-(cache_preamble.size + len(header)) % 8)
+    # The temporary file has a name of its own, in case another process is
+    # writing the same cache at the same time; it gets the same permissions
+    # as a file created in the usual way
+    handle, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(cache_preamble.pack(cache_magic, len(header)))
+            file.write(header)
+            for block in blocks:
+                file.write(block)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpfile, 0o666 & ~umask)
+        os.replace(tmpfile, filename)
+    except BaseException:
+        os.remove(tmpfile)
+        raise
+
+# Read ctspell back in from a compiled cache file by memory mapping it.  The
+# numeric arrays are used in place, straight out of the memory mapped file,
+# so that they only take up space in the operating system's page cache (which
+# is shared between any processes that are using the same cache file).
+# Only the countries in the set of countries are read (or all of them, if it's
+# None).  Returns ctspell plus the set of every country in the cache, or None
+# if the cache file doesn't exist, is unreadable or truncated, or doesn't
+# match the fingerprint of the current city spelling file
+def readcache(filename, fprint, countries=None):
+    try:
+        with open(filename, "rb") as file:
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(buf) < cache_preamble.size:
+        return None
+    magic, hdrlen = cache_preamble.unpack(buf[0:cache_preamble.size])
+    if magic != cache_magic:
+        return None
+    start = cache_preamble.size + hdrlen
+    try:
+        header = json.loads(buf[cache_preamble.size:start].decode("utf-8"))
+    except ValueError:
+        return None
+    if header.get("fingerprint") != fprint:
+        return None
+    view = memoryview(buf)
+    ctspell = {}
+    available = set()
+    for ctry, nrows, offset, sizes in header["countries"]:
+        available.add(ctry)
+        if countries is not None and ctry not in countries:
+            continue
+        pos = start + offset
+        # A truncated file could still have a valid header, so make sure that
+        # the country's blocks are all there
+        if pos + sum(size + (-size % 8) for size in sizes) > len(buf):
+            return None
+        data = []
+        for size in sizes:
+            data.append(view[pos:pos + size])
+            pos = pos + size + (-size % 8)
+        lat, lon = [block.cast("d") for block in data[0:2]]
+        names = [StringTable(bytes(data[ij+1]).decode("utf-8"),
+                             data[ij].cast("I")) for ij in (2, 4, 6)]
+        index = [[block.cast("I") for block in data[8:10]],
+                 [block.cast("I") for block in data[10:12]]]
+        ctspell[ctry] = CityTable(names[0], names[1], names[2], lat, lon,
+                                  index)
+    return ctspell, available
+
+# Build a candidate blocking index for one country's list of cleaned up city
+# names.  The index consists of two inverted indices: the first maps each
+# character to the candidates whose names contain it, and the second maps each
+# long (> 2 character) token to the candidates whose names contain it.  Each
+# posting list holds candidate indices in ascending order as a compact array.
+# The index also encodes the set of characters in each candidate name as a
+# 64-bit mask (see charmask), using a bit assignment specific to the country
+def blockcities(candidates):
+    chars = {}
+    tokens = {}
+    for ii in range(len(candidates)):
+        for c in set(candidates[ii].replace(' ', '')):
+            if c not in chars:
+                chars[c] = array("I")
+            chars[c].append(ii)
+        for token in set(candidates[ii].split()):
+            if len(token) > 2:
+                if token not in tokens:
+                    tokens[token] = array("I")
+                tokens[token].append(ii)
+    # Give the most common characters their own bits; in the unlikely event
+    # that there are more than 63 distinct characters, the remainder all share
+    # the overflow bit
+    charbits = {}
+    for c in sorted(chars.keys(), key=lambda c: -len(chars[c]))[0:63]:
+        charbits[c] = 1 << len(charbits)
+    masks = array("Q", [charmask(cnd, charbits)[0] for cnd in candidates])
+    if numpy is not None:
+        masks = numpy.frombuffer(masks, dtype=numpy.uint64)
+    return [chars, tokens, charbits, masks]
+
+# Encode the set of characters in a city name as a bit mask, given a mapping
+# from characters to bits.  Returns the mask plus the number of distinct
+# characters which have no bit of their own; for those, the overflow bit is
+# also set in the mask
+def charmask(city, charbits):
+    mask = 0
+    extra = 0
+    for c in set(city.replace(' ', '')):
+        if c in charbits:
+            mask = mask | charbits[c]
+        else:
+            mask = mask | overflow_bit
+            extra = extra + 1
+    return mask, extra
+
+# Count the number of bits set in each element of an array of 64-bit masks
+def popcount(masks):
+    if hasattr(numpy, "bitwise_count"): # Available in NumPy 2.0 and later
+        return numpy.bitwise_count(masks)
+    return popcount_table[masks.view(numpy.uint8).reshape(-1, 8)].sum(axis=1)
+
+# Test whether two cleaned up city names have 70% of their letters in common
+def lettersincommon(city, cand):
+    ctyall = re.sub(' +', '', city)
+    cndall = re.sub(' +', '', cand)
+    return sum([c in cndall for c in set(ctyall)]) >= \
+           floor(0.7 * len(set(ctyall+cndall)))
+
+# Use a blocking index to select the subset of candidates which could possibly
+# have 70% of their letters in common with badcity, in ascending order.  Such
+# a candidate must share at least floor(0.7 * n) of the n distinct letters in
+# badcity, and must therefore contain at least one of any n - floor(0.7 * n)
+# + 1 of those letters; by choosing the rarest letters, most candidates can be
+# ruled out without ever looking at them
+def blockcandidates(badcity, blocks, ncand):
+    chars = blocks[0]
+    ctyset = set(badcity.replace(' ', ''))
+    need = int(floor(0.7 * len(ctyset)))
+    if need == 0: # Every candidate is a possible match
+        return range(ncand)
+    postings = sorted([chars.get(c, ()) for c in ctyset], key=len)
+    pool = set()
+    for posting in postings[0:len(ctyset) - need + 1]:
+        pool.update(posting)
+    return sorted(pool)
+
+# Stage one of fixspelling(), using a blocking index: find all candidates
+# which share a long token with badcity, or which have 70% of their letters in
+# common with it.  The letter test compares character bit masks rather than
+# sets; with NumPy, the whole country is tested in a single batch, otherwise
+# the test is applied one by one to the candidates chosen by blockcandidates.
+# Names with characters that don't have their own bit get the exact set test
+def screencandidates(badcity, candidates, blocks):
+    chars, tokens, charbits, masks = blocks
+    idx = set()
+    for token in badcity.split():
+        if len(token) > 2 and token in tokens:
+            idx.update(tokens[token])
+    ctymask, extra = charmask(badcity, charbits)
+    ctymask = ctymask & ~overflow_bit
+    if numpy is not None:
+        common = popcount(masks & numpy.uint64(ctymask))
+        total = popcount(masks | numpy.uint64(ctymask)).astype(numpy.int64)
+        passed = common >= numpy.floor(0.7 * (total + extra))
+        overflow = numpy.flatnonzero(masks & numpy.uint64(overflow_bit))
+        passed[overflow] = False
+        idx.update(numpy.flatnonzero(passed).tolist())
+        for ii in overflow.tolist():
+            if lettersincommon(badcity, candidates[ii]):
+                idx.add(ii)
+        return sorted(idx)
+    for ii in blockcandidates(badcity, blocks, len(candidates)):
+        if ii in idx:
+            continue
+        if masks[ii] & overflow_bit:
+            if lettersincommon(badcity, candidates[ii]):
+                idx.add(ii)
+        elif bin(masks[ii] & ctymask).count("1") >= \
+             floor(0.7 * (bin(masks[ii] | ctymask).count("1") + extra)):
+            idx.add(ii)
+    return sorted(idx)
+
+# Attempt to fix spelling mistakes, if possible.  If a blocking index for the
+# candidates list (see blockcities) is provided, then it is used to speed up
+# the first stage of the algorithm, with identical results.  If a stats list
+# is provided, then the amount of work done in each of the three stages of
+# the algorithm, and the time taken by each of them, are stored in it (see
+# Metrics.observefix)
+def fixspelling(badcity, candidates, blocks=None, stats=None):
 
     if len(badcity) == 0:
         return []
+    if stats is not None:
+        start = time.perf_counter()
            
     # First part of algorithm: search for precisely matching sub-tokens or
     # pairs of complete city name strings with a large number of letters
     # (> 70%) in common.  Strictly speaking, this part isn't actually
     # technically necessary; one could in principle proceed directly to the
     # substring matching step which is implemented in part 2, however, the
-    # difflibs module which is used to implement that part of the overall
-    # algorithm is computationally expensive so we attempt to screen away
-    # the majority of the grossly unlikely matches first by using this series
-    # of two quick albeit somewhat rough matching tests during stage one.
-    idx = []
-    ctytoken = badcity.split()
-    for ii in range(len(candidates)):
-        cndtoken = candidates[ii].split()
-        matched = False
-        # If there are exact matches between any long tokens, add this
-        # candidate city to the idx list
-        for ij in ctytoken:
-            if len(ij) > 2:
-                for ik in cndtoken:
-                    if len(ik) > 2 and ij == ik:
-                        match = True                      
-        if matched:
-            idx.append(ii)
-            continue
- 
-        # If 70% of letters are in common overall, then add to idx list
-        ctyall = re.sub(' +', '', badcity)
-        cndall = re.sub(' +', '', candidates[ii])
-        if sum([c in cndall for c in set(ctyall)]) >= \
-        floor(0.7 * len(set(ctyall+cndall))):
-            idx.append(ii)
+    # longest common substring searches which implement that part of the
+    # overall algorithm are computationally expensive so we attempt to screen
+    # away the majority of the grossly unlikely matches first by using this
+    # series of two quick albeit somewhat rough matching tests during stage
+    # one.
+    if blocks is not None:
+        idx = screencandidates(badcity, candidates, blocks)
+    else:
+        idx = []
+        ctytoken = badcity.split()
+        for ii in range(len(candidates)):
+            cndtoken = candidates[ii].split()
+            matched = False
+            # If there are exact matches between any long tokens, add this
+            # candidate city to the idx list
+            for ij in ctytoken:
+                if len(ij) > 2:
+                    for ik in cndtoken:
+                        if len(ik) > 2 and ij == ik:
+                            matched = True
+            if matched:
+                idx.append(ii)
+                continue
+
+            # If 70% of letters are in common overall, then add to idx list
+            if lettersincommon(badcity, candidates[ii]):
+                idx.append(ii)
+    if stats is not None:
+        stats[0] = len(idx)
+        stage2 = time.perf_counter()
+        stats[3] = stage2 - start
     
     # Second part of algorithm: search for long matching substrings. Candidate
-    # cities which have a lot of matching substrings constitute a likely match
+    # cities which have a lot of matching substrings constitute a likely match.
+    # Whatever is left over of the longer name beyond the length of the
+    # shorter one can't match anything, so candidates which would have too
+    # many letters left over even if everything else matched are skipped
+    # without being searched; likewise after the first search, if the two
+    # pieces on either side of it can't match well enough
     minfrac = 1 # Optimal value will be as close to zero as possible
-    city = []
-    cand = []
-    totlen = []
-    mididx = [] # Index into candidates list of likely matches
+    city = badcity.replace(" ", "") # Get rid of all spaces
+    mid = [] # Likely matches: index into candidates, leftover letters, totlen
+    searches = 0
     for ii in idx:
-        city.append(re.sub(' +', '', badcity)) # Get rid of all spaces
-        cand.append(re.sub(' +', '', candidates[ii])) # Get rid of all spaces
-        totlen.append(len(city[-1]) + len(cand[-1]))
+        cand = candidates[ii].replace(" ", "") # Get rid of all spaces
+        totlen = len(city) + len(cand)
+        if float(abs(len(city) - len(cand)))/totlen > minfrac:
+            continue
         # Find matching substring
-        sm = difflib.SequenceMatcher(None, city[-1], cand[-1])
-        match = sm.find_longest_match(0, len(city[-1]), 0, len(cand[-1]))
+        ia, ib, size = longestmatch(city, cand)
+        searches = searches + 1
         # Throw away matching substring and cleave remainder into two tokens
-        city[-1] = breakstring(city[-1], match.a, match.size)
-        cand[-1] = breakstring(cand[-1], match.b, match.size) 
-        # Loop through the two tokens and look for more matching substrings
-        newcty = []
-        newcnd = []
-        for ij in range(len(city[-1])):    
-            sm = difflib.SequenceMatcher(None, city[-1][ij], cand[-1][ij])
-            match = sm.find_longest_match(0, len(city[-1][ij]), 0, len(cand[-1][ij]))
-            newcty.extend(breakstring(city[-1][ij], match.a, match.size))
-            newcnd.extend(breakstring(cand[-1][ij], match.b, match.size))
-        # The newcty and newcnd variables at this point should each consist
-        # of a list containing four string tokens (with some of them possibly
-        # equal to ''; i.e., effectively empty) that have had large matching
-        # substrings (if any are found) removed from between them.  Glue
-        # these tokens back together to form a single string again.
-        city[-1] = ""
-        for token in newcty:
-            city[-1] = city[-1] + token
-        cand[-1] = ""
-        for token in newcnd:
-            cand[-1] = cand[-1] + token
+        ctyparts = breakstring(city, ia, size)
+        cndparts = breakstring(cand, ib, size)
+        bound = totlen - 2*size
+        for ij in range(2):
+            bound = bound - 2*min(len(ctyparts[ij]), len(cndparts[ij]))
+        if float(bound)/totlen > minfrac:
+            continue
+        # Look for another matching substring in each pair of tokens, and
+        # glue what's left of them back together into a single string again
+        newcty = ""
+        newcnd = ""
+        for ij in range(2):
+            ia, ib, size = longestmatch(ctyparts[ij], cndparts[ij])
+            newcty = newcty + ctyparts[ij][:ia] + ctyparts[ij][ia+size:]
+            newcnd = newcnd + cndparts[ij][:ib] + cndparts[ij][ib+size:]
+        searches = searches + 2
         # For pairs of city/cand strings that had a lot of matching substrings,
         # this value should be small; hopefully close to zero.  Treat these as
         # a "short list" of good matches
-        frac = float(len(city[-1]) + len(cand[-1]))/totlen[-1]
+        frac = float(len(newcty) + len(newcnd))/totlen
         if frac < minfrac: # New best match; discard all previous best matches
-            for ij in range(len(city)-1):
-                city.pop(0)
-                cand.pop(0)
-                totlen.pop(0)
-            mididx = []
-            mididx.append(ii)
+            mid = [(ii, newcty, newcnd, totlen)]
             minfrac = frac
         elif frac == minfrac: # Indistinguishable from previous best match
-            mididx.append(ii)
-        else: # Poor match; discard
-            city.pop(-1)
-            cand.pop(-1)
-            totlen.pop(-1)
+            mid.append((ii, newcty, newcnd, totlen))
+    if stats is not None:
+        stats[1] = searches
+        stage3 = time.perf_counter()
+        stats[4] = stage3 - stage2
+        searches = 0
     
     # By the time the algorithm reaches this stage, indices into the candidates
     # list should point to city names which share a large number of common
@@ -204,38 +795,47 @@ def fixspelling(badcity, candidates):
     # three of the algorithm: after pre-selecting a very small number of
     # cities which have large numbers of matching substrings, choose the
     # best candidate by trying to match as many of the leftover letters as
-    # possible in any order you can.
+    # possible in any order you can.  Letters which only one of the two has
+    # can never be crossed out, so again candidates with too many of those
+    # are skipped without being searched
     finalidx = []
     minfrac = 1
-    for ii in range(len(mididx)):
-        sm = difflib.SequenceMatcher(None, city[ii], cand[ii])
-        match = sm.find_longest_match(0, len(city[ii]), 0, len(cand[ii]))
+    for ii, city, cand, totlen in mid:
+        citychars = set(city)
+        candchars = set(cand)
+        bound = sum(1 for ch in city if ch not in candchars) + \
+                sum(1 for ch in cand if ch not in citychars)
+        if float(bound)/totlen > minfrac:
+            continue
+        ia, ib, size = longestmatch(city, cand)
+        searches = searches + 1
         # Find matching substrings and "cross them out" so to speak
-        while match.size > 0:
-            city[ii] = city[ii].replace(city[ii][match.a:(match.a +\
-            match.size)], '')
-            cand[ii] = cand[ii].replace(cand[ii][match.b:(match.b +\
-            match.size)], '')
-            sm = difflib.SequenceMatcher(None, city[ii], cand[ii])
-            match = sm.find_longest_match(0, len(city[ii]), 0, len(cand[ii]))
+        while size > 0:
+            city = city.replace(city[ia:ia+size], '')
+            cand = cand.replace(cand[ib:ib+size], '')
+            ia, ib, size = longestmatch(city, cand)
+            searches = searches + 1
         # This metric measures how successfully the substring matching strategy
         # has been.  A smaller value (as close to zero as possible) indicates
         # a better match
-        frac = float(len(city[ii]) + len(cand[ii]))/totlen[ii]
+        frac = float(len(city) + len(cand))/totlen
         if frac < minfrac: # New best match
-            finalidx = []
-            finalidx.append(mididx[ii])
+            finalidx = [ii]
             minfrac = frac
         elif frac == minfrac: # Consistent with previous best match
-            finalidx.append(mididx[ii])
+            finalidx.append(ii)
+    if stats is not None:
+        stats[2] = searches
+        stats[5] = time.perf_counter() - stage3
             
     return finalidx
 
 # Read in the country code file as a dictionary (first 3 lines), and then
 # create an inverse lookup for use with airports_file
-with open(countrymap_file, "r") as file:
-    alldata = csv.reader(file, delimiter = "|")
-    ctrymap = dict(alldata)
+def loadcountrymap(filename):
+    with open(filename, "r", encoding=file_encoding) as file:
+        alldata = csv.reader(file, delimiter = "|")
+        ctrymap = dict(alldata)
     invcmap = {v: k for k, v in ctrymap.items()}
     invcmap['South Korea'] = 'KR'
     invcmap['North Korea'] = 'KP'
@@ -276,109 +876,423 @@ with open(countrymap_file, "r") as file:
     invcmap['British Indian Ocean Territory'] = 'GB'
     invcmap['Johnston Atoll'] = 'UNKNOWN'
     invcmap['Antarctica'] = 'MULTIPLE'
-    flprt("Country code directory is successfully loaded...")
-
-# Read in the city spelling / master geocode file as a list within a
-# dictionary which is keyed by country
-flprt("Loading third party city spelling dictionary, " + 
-      "please wait about two minutes...")
-ctspell = {}
-with open(cityspelling_file, "r") as file:
+    return ctrymap, invcmap
+
+# Read in the city spelling / master geocode file as a CityTable within a
+# dictionary which is keyed by country.  If a compiled cache of the file
+# already exists and is up to date, load that instead; otherwise parse the
+# original text file and compile a new cache for use on subsequent runs.
+# If a set of countries is given, then only those countries are returned;
+# the whole file is still parsed in order to compile the cache, and the
+# countries are then read back from the new cache, so that the others don't
+# stay in memory.  Unless compilecache is set (and the cache file can be
+# written at all), the rows for the other countries are instead skipped
+# without parsing them, and no cache is compiled (e.g., for loading one more
+# country after the cache has already been tried).
+# Returns the dictionary, the fingerprint of the file (which can be passed
+# back in to save recomputing it), and the set of every country in the file
+def loadcityspelling(filename, cachefile, log, countries=None, fprint=None,
+                     workers=1, compilecache=True):
+    if fprint is None:
+        fprint = fingerprint(filename)
+    cached = readcache(cachefile, fprint, countries)
+    if cached is not None:
+        log("Third party city spelling directory is successfully loaded " +
+            "from compiled cache; " +
+            "{0} elapsed".format(datetime.datetime.now()-t0))
+        return cached[0], fprint, cached[1]
+    if compilecache and countries is not None and \
+       not cachewritable(cachefile):
+        log("Compiled city spelling cache can't be written to " + cachefile +
+            "; only the countries needed will be loaded")
+        compilecache = False
+    if compilecache:
+        wanted = None
+    else:
+        wanted = countries
+    if wanted is None:
+        log("Loading third party city spelling dictionary, " + 
+            "please wait about two minutes...")
+    else:
+        log("Loading third party city spelling dictionary for " +
+            "{0} countries, please wait...".format(len(wanted)))
+    available = set()
+    if workers > 1 and not filename.endswith(".gz"):
+        ctspell = parallelcities(filename, wanted, available, workers)
+    else:
+        with opencities(filename) as file:
+            next(file) # Skip column headers in first line
+            ctspell = {ctry: CityTable(*columns) for ctry, columns in
+                       parsecities(file, wanted, available).items()}
+    log("Third party city spelling directory is successfully " +
+        "loaded; {0} elapsed".format(datetime.datetime.now()-t0))
+    if wanted is not None:
+        return ctspell, fprint, available
+    available = set(ctspell.keys())
+    try:
+        writecache(cachefile, ctspell, fprint)
+        log("Compiled city spelling cache is written to " + cachefile)
+    except (IOError, OSError) as err:
+        log("Compiled city spelling cache could not be written to " +
+            cachefile + ": {0}".format(err))
+    if countries is None:
+        return ctspell, fprint, available
+    cached = readcache(cachefile, fprint, countries)
+    if cached is not None:
+        return cached[0], fprint, available
+    return ({ctry: ctspell[ctry] for ctry in ctspell.keys() if ctry in
+             countries}, fprint, available)
+
+# Whether a compiled cache file can be written (see writecache), which needs
+# its directory to exist and be writable
+def cachewritable(cachefile):
+    return os.access(os.path.dirname(os.path.abspath(cachefile)), os.W_OK)
+
+# Open the city spelling file as text; a gzipped file (as downloaded from
+# MaxMind) is decompressed on the fly as it's read
+def opencities(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", encoding=file_encoding)
+    return open(filename, "r", encoding=file_encoding)
+
+# Parse lines of the city spelling file (without the column headers) into the
+# columns of a CityTable for each country, minus the exact match indices, with
+# the rows in file order.  If a set of countries is given, then the lines for
+# any other country are skipped (see countrylines)
+def parsecities(file, countries=None, found=None):
+    ctspell = {}
+    if countries is not None:
+        file = countrylines(file, countries, found)
     alldata = csv.reader(file, delimiter = ",")
-    alldata.next() # Skip column headers in first line
     for ctry, city, acccity, reg, pop, lat, lon in alldata:
-        ctry = ctry.upper() # Convert to upper case to match other files
-        city = city.upper()
-        if ctry in ctspell.keys(): # Usual case: append another city
-            ctspell[ctry].append([city, cleanup(city), acccity, float(lat),
-                                  float(lon)])
-        else: # First time a new country is encountered
-            ctspell[ctry] = [[city, cleanup(city), acccity, float(lat),
-                              float(lon)]]
-    flprt("Third party city spelling directory is successfully loaded; " +
-          "{0} elapsed".format(datetime.datetime.now()-t0))
+        # Convert to upper case to match other files
+        ctry = normalize.upper(ctry)
+        city = normalize.upper(city)
+        if ctry not in ctspell.keys(): # New country is encountered
+            ctspell[ctry] = [[], [], array("d"), array("d")]
+        columns = ctspell[ctry]
+        columns[0].append(city)
+        columns[1].append(acccity)
+        columns[2].append(float(lat))
+        columns[3].append(float(lon))
+    # Clean up each country's city names all at once (many of which are
+    # repeated within a country, so only clean up each distinct one once),
+    # and convert its lists of names into compact tables
+    for ctry in ctspell.keys():
+        columns = ctspell[ctry]
+        clean = normalize.normalize_many(columns[0], {})
+        ctspell[ctry] = [StringTable.fromlist(columns[0]),
+                         StringTable.fromlist(clean),
+                         StringTable.fromlist(columns[1]),
+                         columns[2], columns[3]]
+    return ctspell
+
+# Parse one byte range of the city spelling file, which starts and ends on
+# line boundaries; this is the unit of work which is handed to worker
+# processes by parallelcities.  Returns the CityTable columns for each
+# country, including the exact match indices for the rows in this range, plus
+# the country codes seen if only some countries are wanted
+def parsechunk(task):
+    filename, start, end, countries = task
+    with open(filename, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    found = set()
+    # Decode the same way as opencities would, newline handling included
+    text = io.TextIOWrapper(io.BytesIO(data), encoding=file_encoding)
+    ctspell = parsecities(text, countries, found)
+    for columns in ctspell.values():
+        columns.append(hashindex(columns[0]))
+        columns.append(hashindex(columns[1]))
+    return ctspell, found
+
+# Load the city spelling file by splitting it into byte ranges on line
+# boundaries, parsing those in a pool of worker processes, and joining each
+# country's rows from all of the ranges back together in their original
+# order (so that which of several equally good matches comes first doesn't
+# change).  There are a few ranges per worker, to even out the load
+def parallelcities(filename, countries, found, workers):
+    size = os.path.getsize(filename)
+    nchunks = workers*load_chunks
+    bounds = []
+    with open(filename, "rb") as file:
+        file.readline() # Skip column headers in first line
+        bounds.append(file.tell())
+        for ii in range(1, nchunks):
+            file.seek(max(bounds[-1], size*ii//nchunks))
+            file.readline() # Move on to the start of the next line
+            bounds.append(file.tell())
+    bounds.append(size)
+    tasks = [(filename, bounds[ii], bounds[ii+1], countries) for ii in
+             range(nchunks) if bounds[ii] < bounds[ii+1]]
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        chunks = pool.map(parsechunk, tasks, 1)
+    parts = {}
+    for ctspell, seen in chunks:
+        found.update(seen)
+        for ctry, columns in ctspell.items():
+            parts.setdefault(ctry, []).append(columns)
+    ctspell = {}
+    for ctry, pieces in parts.items():
+        lat = array("d")
+        lon = array("d")
+        for columns in pieces:
+            lat.extend(columns[3])
+            lon.extend(columns[4])
+        sizes = [len(columns[3]) for columns in pieces]
+        ctspell[ctry] = CityTable(
+            StringTable.concat([columns[0] for columns in pieces]),
+            StringTable.concat([columns[1] for columns in pieces]),
+            StringTable.concat([columns[2] for columns in pieces]), lat, lon,
+            [mergeindex([columns[5] for columns in pieces], sizes),
+             mergeindex([columns[6] for columns in pieces], sizes)])
+    return ctspell
+
+# Pass through only those lines of the city spelling file which belong to one
+# of the countries, judging by the country code at the start of each line
+# (which is never quoted), and add every country code seen to found
+def countrylines(file, countries, found):
+    codes = {}
+    for line in file:
+        code = line[:line.find(",")]
+        ctry = codes.get(code)
+        if ctry is None:
+            ctry = normalize.upper(code)
+            codes[code] = ctry
+            found.add(ctry)
+        if ctry in countries:
+            yield line
+
+# Find the set of country codes used in the unvalidated file
+def prescan(filename):
+    with open(filename, "r", encoding=file_encoding) as infile:
+        alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+        next(alldata) # Skip column headers in first line
+        return {ctry for city, ctry in alldata}
 
 # Read in the airport supplementary geocode file as a list within a
-# dictionary which is keyed by country and city
-airports = {}
-with open(airports_file, "r") as file:
-    alldata = csv.reader(file, delimiter = ',', quotechar = '"')
-    for apid, name, city, country, iatafaa, icao, lat, lon, alt, tz,\
-    dst in alldata:
-        # Skip pre-averaged latitiude/longitude values for about a dozen
-        # major cities; we'll compute this ourselves for all of them later,
-        # not just a tiny subset
-        if name == "All Airports":
-            pass
-        # Check whether the country name appears in the inverse country map
-        if country in invcmap.keys():
-            ctry = invcmap[country]
-        else:
-            ctry = 'NO KEY'
-        # Get rid of nuisance characters
-        city = cleanup(city)
+# dictionary which is keyed by country and city.  If a set of countries is
+# given, then the airports in any other country are skipped
+def loadairports(filename, invcmap, countries=None):
+    rows = []
+    with open(filename, "r", encoding=file_encoding) as file:
+        alldata = csv.reader(file, delimiter = ',', quotechar = '"')
+        for apid, name, city, country, iatafaa, icao, lat, lon, alt, tz,\
+        dst in alldata:
+            # Skip pre-averaged latitiude/longitude values for about a dozen
+            # major cities; we'll compute this ourselves for all of them
+            # later, not just a tiny subset
+            if name == "All Airports":
+                pass
+            # Check whether the country name appears in the inverse country
+            # map
+            if country in invcmap.keys():
+                ctry = invcmap[country]
+            else:
+                ctry = 'NO KEY'
+            if countries is not None and ctry not in countries:
+                continue
+            rows.append((ctry, city, float(lat), float(lon)))
+    # Get rid of nuisance characters, all at once (many cities have several
+    # airports, so only clean up each distinct city name once)
+    clean = normalize.normalize_many([row[1] for row in rows], {})
+    airports = {}
+    for (ctry, _, lat, lon), city in zip(rows, clean):
         if ctry in airports.keys():
             # New airport for a city already previously encountered
             if city in airports[ctry].keys():
-                airports[ctry][city].append([float(lat), float(lon)])
+                airports[ctry][city].append([lat, lon])
             # New city encountered
             else:
-                airports[ctry][city] = [[float(lat), float(lon)]]
+                airports[ctry][city] = [[lat, lon]]
         # New country encountered
         else:
             airports[ctry] = {}
-            airports[ctry][city] = [[float(lat), float(lon)]]
-# For cities with multiple ports, take city location as average of all
-# port latitudes and longitudes
-for ii in airports.keys():
-    for ij in airports[ii].keys():
-        lat = [airports[ii][ij][ik][0] for ik in range(len(airports[ii][ij]))]
-        lon = [airports[ii][ij][ik][1] for ik in range(len(airports[ii][ij]))]   
-        airports[ii][ij] = [sum(lat)/len(lat), sum(lon)/len(lon)]
-flprt("Third party airports directory is successfully loaded...")
-
-flprt("Data validation in process, please wait; " +
-      "periodic progress updates will be provided every 3 minutes or so...")
-prevseen = {}
-unqlst = []
-s = "'{0}','{1}',{2},'{3}','{4}','{5}',{6},{7}\n" # Output format string
-# Read in the unvalidated file line by line and attempt to correct it
-with open(unvalid_file, "r") as infile, open(processed_file, "w") as outfile:
-    # Print column headers to output file
-    outfile.writelines(column_headers)               
-    alldata = csv.reader(infile, delimiter = "|", quotechar="'")
-    alldata.next() # Skip column headers in first line
-    ii = 1 # Line counter (this seems to be only way to do it in Python)
-    for city, ctry in alldata:
-        matched = False
-        # Skip time-consuming search, if we've encounterd this city before
-        if ctry in prevseen.keys(): # Country has previously been encountered
-            if city in prevseen[ctry].keys(): # City was previously encountered
-                outfile.writelines(prevseen[ctry][city])
-                if not ii%10000: # Send periodic status update to stdout
-                    flprt("    {0} lines finished; ".format(ii) +
-                          "{0} elapsed".format(datetime.datetime.now()-t0))
-                ii = ii + 1
+            airports[ctry][city] = [[lat, lon]]
+    # For cities with multiple ports, take city location as average of all
+    # port latitudes and longitudes
+    for ii in airports.keys():
+        for ij in airports[ii].keys():
+            lat = [airports[ii][ij][ik][0] for ik in
+                   range(len(airports[ii][ij]))]
+            lon = [airports[ii][ij][ik][1] for ik in
+                   range(len(airports[ii][ij]))]
+            airports[ii][ij] = [sum(lat)/len(lat), sum(lon)/len(lon)]
+    return airports
+
+# The validated output values for one input city, in the same order as the
+# columns of the output files.  The latitude and longitude are '' when they
+# aren't known, as are the other output values (except for the quality code)
+# when the city or country isn't recognized
+ValidationResult = namedtuple("ValidationResult", ["inputcity", "inputctry",
+                              "quality", "cityascii", "cityaccent",
+                              "ctryname", "lat", "lon"])
+
+# Validates city names against the reference data (parts III through V of the
+# outline above), which is loaded once when the Validator is created and then
+# kept in memory for any number of validations.  For example:
+#
+#     validator = Validator(verbose=False)
+#     result = validator.validate("COPEHNAGEN", "DK")
+#     print(result.quality, result.cityaccent, result.lat, result.lon)
+class Validator(object):
+
+    def __init__(self, countrymap_file=countrymap_file,
+                 cityspelling_file=cityspelling_file,
+                 airports_file=airports_file, cityspelling_cache=None,
+                 verbose=True, metrics=None, matcher="difflib",
+                 maxdistance=matchers.default_maxdistance, countries=None,
+                 workers=1):
+        if cityspelling_cache is None:
+            cityspelling_cache = cachefilename(cityspelling_file)
+        if metrics is None:
+            metrics = Metrics()
+        self.verbose = verbose
+        self.metrics = metrics
+        self.matcher = matcher
+        self.maxdistance = maxdistance
+        self.cityspelling_file = cityspelling_file
+        self.cityspelling_cache = cityspelling_cache
+        self.airports_file = airports_file
+        with metrics.stage("country_map_load"):
+            self.ctrymap, self.invcmap = loadcountrymap(countrymap_file)
+        self.log("Country code directory is successfully loaded...")
+        with metrics.stage("gazetteer_load"):
+            self.ctspell, self.cityfprint, available = loadcityspelling(
+                cityspelling_file, cityspelling_cache, self.log, countries,
+                workers=workers)
+        with metrics.stage("airport_aggregation"):
+            self.airports = loadairports(airports_file, self.invcmap,
+                                         countries)
+        # Countries which are in the city spelling file, but haven't been
+        # loaded yet (if only some countries were asked for); each of these
+        # is loaded the first time that it's needed
+        self.pending = available - set(self.ctspell.keys())
+        self.log("Third party airports directory is successfully loaded...")
+        # Blocking indices for fixspelling(), or indices for the other
+        # matching engines, per country; these are only built for countries
+        # where they are actually needed
+        self.ctblocks = {}
+        self.ctfuzzy = {}
+
+    # Print a progress message, unless the Validator was created quietly
+    def log(self, msg):
+        if self.verbose:
+            flprt(msg)
+
+    # Load the city spelling and airport data for a country which wasn't
+    # loaded up front
+    def loadcountry(self, ctry):
+        quiet = lambda msg: None
+        with self.metrics.stage("gazetteer_load"):
+            ctspell, fprint, available = loadcityspelling(
+                self.cityspelling_file, self.cityspelling_cache, quiet,
+                {ctry}, self.cityfprint, compilecache=False)
+            self.ctspell.update(ctspell)
+        with self.metrics.stage("airport_aggregation"):
+            self.airports.update(loadairports(self.airports_file,
+                                              self.invcmap, {ctry}))
+        self.pending.discard(ctry)
+        self.metrics.count("countries_loaded_on_demand")
+        self.log("Reference data for country " + ctry + " is loaded")
+
+    # Get the cleaned up candidate city names and blocking index for
+    # fixspelling() for one country, building the index the first time that
+    # it's needed
+    def candidateblocks(self, ctry):
+        if ctry not in self.ctblocks:
+            start = time.perf_counter()
+            self.ctblocks[ctry] = blockcities(self.ctspell[ctry].clean)
+            self.metrics.count("blocking_index_seconds",
+                               time.perf_counter() - start)
+            self.metrics.count("blocking_indices")
+        return self.ctspell[ctry].clean, self.ctblocks[ctry]
+
+    # Get the index of one country's distinct cleaned up city names for the
+    # selected matching engine (see matchers.py), building it the first time
+    # that it's needed
+    def fuzzyindex(self, ctry):
+        if ctry not in self.ctfuzzy:
+            start = time.perf_counter()
+            names = list(dict.fromkeys(name for name in
+                                       self.ctspell[ctry].clean if name))
+            self.ctfuzzy[ctry] = matchers.engines[self.matcher](
+                names, self.maxdistance)
+            self.metrics.count("matcher_index_seconds",
+                               time.perf_counter() - start)
+            self.metrics.count("matcher_indices")
+        return self.ctfuzzy[ctry]
+
+    # Build the blocking indices, or the indices for the other matching
+    # engines, up front for the given countries (or every country that's
+    # loaded), so that forked worker processes all share a single copy of
+    # them rather than each building their own
+    def prepare(self, countries=None):
+        if countries is None:
+            countries = self.ctspell.keys()
+        for ctry in sorted(countries):
+            if ctry not in self.ctspell:
                 continue
-        else: # New country encountered
-            prevseen[ctry] = {}
+            if self.matcher == "difflib":
+                self.candidateblocks(ctry)
+            else:
+                self.fuzzyindex(ctry)
+
+    # Find the best guesses as to the correct spelling of a (cleaned up) city
+    # name which has no exact match within its country, using the selected
+    # matching engine; returns their indices in the country's CityTable
+    # (empty if there aren't any)
+    def fixcity(self, badcity, ctry):
+        if self.matcher == "difflib":
+            candidates, blocks = self.candidateblocks(ctry)
+            fixstats = [0]*6
+            idx = fixspelling(badcity, candidates, blocks, fixstats)
+            self.metrics.observefix(fixstats)
+            return idx
+        index = self.fuzzyindex(ctry)
+        start = time.perf_counter()
+        idx = []
+        for name in index.lookup(badcity):
+            idx.extend(self.ctspell[ctry].find(name, 1))
+        self.metrics.histograms["matcher_seconds"].observe(
+            time.perf_counter() - start)
+        return sorted(idx)
+
+    # Validate a single input city name within its country, and return the
+    # ValidationResult for it
+    def validate(self, city, ctry):
+        start = time.perf_counter()
+        v = self.match(city, ctry)
+        self.metrics.observe(v, time.perf_counter() - start)
+        return v
+
+    # The matching rules themselves, for validate()
+    def match(self, city, ctry):
+        if ctry in self.pending:
+            self.loadcountry(ctry)
+        ctspell = self.ctspell
+        ctrymap = self.ctrymap
+        airports = self.airports
+        matched = False
         if ctry in ctspell.keys(): # Country code is recognized
             for ij in range(2):
                 if not matched:
                     if ij == 0:
-                        # Use the raw city name on the first attempt at a match
+                        # Use the raw city name on the first attempt at a
+                        # match
                         usecity = city
                     else:
                         # If that doesn't produce a match, use a slightly
                         # cleaned up version of the city name on the 2nd pass
-                        usecity = cleanup(city)
+                        usecity = clean = cleanup(city)
                     # Find all matches to city within this country
-                    idx = [ik for ik in range(len(ctspell[ctry])) if
-                           ctspell[ctry][ik][ij] == usecity]
+                    idx = ctspell[ctry].find(usecity, ij)
                     if len(idx) == 1: # Case 1 or 4: exactly one match
-                        v = [city, ctry, (3*ij + 1), ctspell[ctry][idx[0]][0],
-                             ctspell[ctry][idx[0]][2], ctrymap[ctry],
-                             ctspell[ctry][idx[0]][3], ctspell[ctry][idx[0]][4]]
+                        v = [city, ctry, (3*ij + 1),
+                             ctspell[ctry].city[idx[0]],
+                             ctspell[ctry].accent[idx[0]], ctrymap[ctry],
+                             ctspell[ctry].lat[idx[0]],
+                             ctspell[ctry].lon[idx[0]]]
                         matched = True
                     elif len(idx) > 1: # Case 2 & 3 or 5 & 6, multiple matches
                         # Attempt to select best lat and lon as the one which
@@ -386,8 +1300,8 @@ with open(unvalid_file, "r") as infile, open(processed_file, "w") as outfile:
                         if usecity in airports[ctry].keys(): 
                             # Case 2 or 5: found airport
                             v = [city, ctry, (3*ij + 2),
-                                 ctspell[ctry][idx[0]][0],
-                                 ctspell[ctry][idx[0]][2], ctrymap[ctry],
+                                 ctspell[ctry].city[idx[0]],
+                                 ctspell[ctry].accent[idx[0]], ctrymap[ctry],
                                  airports[ctry][usecity][0],
                                  airports[ctry][usecity][1]]
                         else:
@@ -395,50 +1309,862 @@ with open(unvalid_file, "r") as infile, open(processed_file, "w") as outfile:
                             # different states, provinces, or regions) but no
                             # airport
                             v = [city, ctry, (3*ij + 3),
-                                 ctspell[ctry][idx[0]][0],
-                                 ctspell[ctry][idx[0]][2], ctrymap[ctry],
+                                 ctspell[ctry].city[idx[0]],
+                                 ctspell[ctry].accent[idx[0]], ctrymap[ctry],
                                  '', '']
                         matched = True
             if not matched:
                 # Final attempt: search for looser matches and treat those
                 # cases as spelling errors in need of auto-correction
-                candidates = [ctspell[ctry][ik][1] for ik in 
-                              range(len(ctspell[ctry]))]
-                idx = fixspelling(cleanup(city), candidates)
+                idx = self.fixcity(clean, ctry)
                 if len(idx) > 0:
                     # Case 7: best guess as to spelling
-                    v = [city, ctry, 7, ctspell[ctry][idx[0]][0],
-                         ctspell[ctry][idx[0]][2], ctrymap[ctry],
-                         ctspell[ctry][idx[0]][3], ctspell[ctry][idx[0]][4]]
+                    v = [city, ctry, 7, ctspell[ctry].city[idx[0]],
+                         ctspell[ctry].accent[idx[0]], ctrymap[ctry],
+                         ctspell[ctry].lat[idx[0]], ctspell[ctry].lon[idx[0]]]
                 else:
                     # Case 8: city not recognized
                     v = [city, ctry, 8, '', '', ctrymap[ctry], '', '']
         else: # Case 9: country code is not recognized
             v = [city, ctry, 9, '', '', '', '', '']
-        # Add this city to the dictionary of previously seen cities, and to the
-        # list of unique cities (basically same underlying data, but different
-        # formating) and also write it to the output file
-        prevseen[ctry][city] = s.format(v[0], v[1], v[2], v[3], v[4], v[5],
-                                        v[6], v[7])
-        outfile.writelines(prevseen[ctry][city])
-        unqlst.append(v)
+        return ValidationResult(*v)
+
+    # Validate any number of (city, country) pairs, and return a list of
+    # their ValidationResults in the same order
+    def validate_batch(self, pairs):
+        return [self.validate(city, ctry) for city, ctry in pairs]
+
+    # Identify the version of the reference data and matching rules which
+    # validation results depend on (see resultversion)
+    def version(self):
+        return resultversion(self.cityfprint, self.airports_file,
+                             self.ctrymap, self.invcmap, self.matcher,
+                             self.maxdistance)
+
+# Identify the version of the reference data and matching rules which
+# validation results depend on: the contents of the city spelling and airport
+# files (given the fingerprint of the city spelling file), the country map
+# (including the manual additions to its inverse), and the code of the
+# matching functions themselves, plus matcher_version, all hashed together,
+# followed by the matching engine's settings, as "hash/matcher/maxdistance"
+# (so that compactresultcache can tell results which are merely for other
+# settings from stale ones).  This doesn't need the reference data to be
+# loaded
+def resultversion(cityfprint, airports_file, ctrymap, invcmap, matcher,
+                  maxdistance):
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps([cityfprint["sha1"], cityfprint["cleanup"],
+                            filehash(airports_file), sorted(ctrymap.items()),
+                            sorted(invcmap.items()), matcher_version,
+                            file_encoding]).encode("utf-8"))
+    for func in [Validator.match, Validator.fixcity, Validator.fuzzyindex,
+                 matchers.editdistance, matchers.deletions,
+                 matchers.SymSpellIndex.__init__,
+                 matchers.SymSpellIndex.lookup, matchers.BKTree.insert,
+                 matchers.BKTree.lookup, fixspelling, screencandidates,
+                 blockcandidates, lettersincommon, charmask, blockcities,
+                 CityTable.find, breakstring, longestmatch, cleanup]:
+        hashcode(func.__code__, sha1)
+    return "{0}/{1}/{2}".format(sha1.hexdigest(), matcher, maxdistance)
+
+# Name of the compiled cache file for a city spelling file
+def cachefilename(filename):
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    if filename == cityspelling_file:
+        return cityspelling_cache
+    return os.path.splitext(filename)[0] + ".cache"
+
+# Validator used by worker processes; this is set before the worker pool is
+# forked, so that each worker inherits it
+worker_validator = None
+
+# Validate a list of (city, country) pairs; this is the unit of work which is
+# handed to worker processes.  Returns the results, plus the metrics collected
+# while producing them, for merging into the main process's metrics
+def validatemany(pairs):
+    worker_validator.metrics.reset()
+    return worker_validator.validate_batch(pairs), worker_validator.metrics
+
+# Format a latitude or longitude for processed_file the way that str() did in
+# Python 2, which is what the original script's output_format used: with 12
+# significant digits, rather than as many as it takes to identify the float
+# exactly (so e.g. an average of airport locations comes out as 78.9468625
+# rather than 78.94686250000001).  A missing location ('') is left as it is
+def formatcoord(x):
+    if not isinstance(x, float):
+        return x
+    s = "%.12g" % x
+    if "." in s or "e" in s or "n" in s: # Includes inf and nan
+        return s
+    # Whole numbers get a ".0", unless that would take more than 12 digits,
+    # in which case they're written with an exponent instead
+    if len(s.lstrip("-")) < 12:
+        return s + ".0"
+    mantissa, exponent = ("%.11e" % x).split("e")
+    return mantissa.rstrip("0").rstrip(".") + "e" + exponent
+
+# Format a validation result as a line of processed_file
+def outputline(v):
+    return output_format.format(v[0], v[1], v[2], v[3], v[4], v[5],
+                                formatcoord(v[6]), formatcoord(v[7]))
+
+# Validate a list of (city, country) pairs, either in this process, or split
+# into chunks and farmed out to a pool of worker processes.  Either way, the
+# results are returned in the same order as the pairs.  If a result cache is
+# provided, then only those pairs which aren't already in it are validated
+def validatepairs(validator, pairs, pool, cache=None):
+    if cache is not None:
+        results = lookupresults(cache, pairs)
+        missing = [pairs[ii] for ii in range(len(pairs)) if results[ii] is None]
+        for v in results:
+            if v is not None:
+                validator.metrics.countquality(v.quality)
+    else:
+        results = [None]*len(pairs)
+        missing = pairs
+    if pool is None:
+        found = validator.validate_batch(missing)
+    else:
+        chunks = [missing[ii:ii+worker_chunk] for ii in
+                  range(0, len(missing), worker_chunk)]
+        found = []
+        for chunk, workermetrics in pool.map(validatemany, chunks, 1):
+            found.extend(chunk)
+            validator.metrics.merge(workermetrics)
+    if cache is not None:
+        storeresults(cache, found)
+    found = iter(found)
+    return [v if v is not None else next(found) for v in results]
+
+# Open (or create) the persistent cache of validation results, which keeps the
+# output values of each (city, country) pair validated by previous runs, keyed
+# by the version of the reference data (see Validator.version).  The cache is
+# represented as a list holding the database connection, the current version,
+# and a dictionary of hit and miss counts
+def openresultcache(filename, version):
+    db = sqlite3.connect(filename)
+    db.execute("CREATE TABLE IF NOT EXISTS results (version TEXT, " +
+               "ctry TEXT, city TEXT, quality, cityascii, cityaccent, " +
+               "ctryname, lat, lon, PRIMARY KEY (version, ctry, city)) " +
+               "WITHOUT ROWID")
+    db.commit()
+    return [db, version, {"hits": 0, "misses": 0}]
+
+# Look up a list of (city, country) pairs in the result cache; returns a list
+# of output values, with None in place of any pair which isn't cached
+def lookupresults(cache, pairs):
+    db, version, stats = cache
+    results = []
+    for city, ctry in pairs:
+        row = db.execute("SELECT quality, cityascii, cityaccent, ctryname, " +
+                         "lat, lon FROM results WHERE version = ? AND " +
+                         "ctry = ? AND city = ?",
+                         (version, ctry, city)).fetchone()
+        if row is None:
+            stats["misses"] = stats["misses"] + 1
+            results.append(None)
+        else:
+            stats["hits"] = stats["hits"] + 1
+            results.append(ValidationResult(city, ctry, *row))
+    return results
+
+# Add a list of validation results to the result cache
+def storeresults(cache, results):
+    db, version = cache[0:2]
+    db.executemany("INSERT OR REPLACE INTO results VALUES " +
+                   "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [[version, v.inputctry, v.inputcity] + list(v[2:])
+                    for v in results])
+    db.commit()
+
+# Remove every entry from the result cache which belongs to some version of
+# the reference data or matching code other than the current one, and reclaim
+# the disk space that they used.  Entries for the current version with other
+# matching engine settings (see resultversion) are kept.  Returns the number
+# of entries removed
+def compactresultcache(cache):
+    db, version = cache[0:2]
+    prefix = version.split("/")[0] + "/"
+    removed = db.execute("DELETE FROM results WHERE substr(version, 1, ?) " +
+                         "!= ?", (len(prefix), prefix)).rowcount
+    db.commit()
+    db.execute("VACUUM")
+    return removed
+
+# Read (city, country) pairs from the unvalidated file in batches.  A batch
+# ends once it contains either maxnew pairs which have never been seen before,
+# or maxlines pairs in total.  The pairs which are new are marked as pending
+# in prevseen, and also returned as a separate list along with the batch
+def readbatches(alldata, prevseen, maxnew, maxlines):
+    lines = []
+    newpairs = []
+    for city, ctry in alldata:
+        lines.append((city, ctry))
+        if ctry not in prevseen.keys(): # New country encountered
+            prevseen[ctry] = {}
+        if city not in prevseen[ctry].keys(): # New city encountered
+            prevseen[ctry][city] = None
+            newpairs.append((city, ctry))
+        if len(newpairs) >= maxnew or len(lines) >= maxlines:
+            yield lines, newpairs
+            lines = []
+            newpairs = []
+    if len(lines) > 0:
+        yield lines, newpairs
+
+# Create the temporary on-disk database used in --streaming mode, which holds
+# the unique (city, country) pairs found in the input, and their validated
+# output values.  SQLite's own page cache is limited to a quarter of the
+# memory budget; the rest is left for the in-memory buffers
+def openpairsdb(budget):
+    handle, dbfile = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    db = sqlite3.connect(dbfile)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA cache_size = {0}".format(-budget*1024//4))
+    db.execute("CREATE TABLE pairs (ctry TEXT, city TEXT, " +
+               "PRIMARY KEY (ctry, city)) WITHOUT ROWID")
+    db.execute("CREATE TABLE resolved (ctry TEXT, city TEXT, quality, " +
+               "cityascii, cityaccent, ctryname, lat, lon, line, " +
+               "PRIMARY KEY (ctry, city)) WITHOUT ROWID")
+    return db, dbfile
+
+# First pass of --streaming mode: collect the distinct (city, country) pairs
+# in the input.  They are gathered in memory until there are maxpairs of them,
+# and then spilled to disk, so memory use doesn't depend on the input length
+def collectpairs(alldata, db, maxpairs):
+    pairs = set()
+    nlines = 0
+    for city, ctry in alldata:
+        pairs.add((ctry, city))
+        nlines = nlines + 1
+        if len(pairs) >= maxpairs:
+            db.executemany("INSERT OR IGNORE INTO pairs VALUES (?, ?)",
+                           sorted(pairs))
+            pairs = set()
+    db.executemany("INSERT OR IGNORE INTO pairs VALUES (?, ?)", sorted(pairs))
+    db.commit()
+    return nlines
+
+# Validate each distinct (city, country) pair collected by collectpairs()
+# exactly once, in batches (which are handed to the worker processes, if any,
+# after checking the result cache), and store the results on disk.  Returns
+# the number of distinct pairs
+def resolvepairs(validator, db, pool, batchsize, cache):
+    reader = db.cursor()
+    reader.execute("SELECT city, ctry FROM pairs ORDER BY ctry, city")
+    npairs = 0
+    pairs = reader.fetchmany(batchsize)
+    while len(pairs) > 0:
+        db.executemany("INSERT INTO resolved VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [[v[1], v[0], v[2], v[3], v[4], v[5], v[6], v[7],
+                         outputline(v)]
+                        for v in validatepairs(validator, pairs, pool,
+                                               cache)])
+        npairs = npairs + len(pairs)
+        flprt("    {0} unique cities finished; ".format(npairs) +
+              "{0} elapsed".format(datetime.datetime.now()-t0))
+        validator.metrics.writesnapshot()
+        pairs = reader.fetchmany(batchsize)
+    db.execute("DELETE FROM pairs")
+    db.commit()
+    return npairs
+
+# Second pass of --streaming mode: write out the output line for every input
+# line, in order, by looking up the validated results stored on disk.  The
+# most recently used results are kept in memory, up to maxpairs of them
+def writeprocessed(alldata, outfile, db, maxpairs):
+    recent = {}
+    ii = 1
+    for city, ctry in alldata:
+        line = recent.get((ctry, city))
+        if line is None:
+            line = db.execute("SELECT line FROM resolved WHERE ctry = ? " +
+                              "AND city = ?", (ctry, city)).fetchone()[0]
+            if len(recent) >= maxpairs:
+                recent = {}
+            recent[(ctry, city)] = line
+        outfile.writelines(line)
         if not ii%10000: # Send periodic status update to stdout
             flprt("    {0} lines finished; ".format(ii) +
                   "{0} elapsed".format(datetime.datetime.now()-t0))
         ii = ii + 1
-    flprt("Data validation is finished; " +
-          "{0} elapsed!".format(datetime.datetime.now()-t0))
-
-flprt("Dumping unique cities list to output file; please wait...")
-# Sort the list of unique cities by quality indicator first, then
-# alphabetically by country, and finally alphabetically by city
-unqlst = sorted(unqlst, key=itemgetter(2, 1, 0))
-with open(unique_file, "w") as outfile:
-    # Print column headers to output file
-    outfile.writelines(column_headers)
-    # Print data to the output file
-    writer = csv.writer(outfile, quotechar = "'", quoting=csv.QUOTE_NONNUMERIC,
-                        lineterminator='\n')
-    writer.writerows(unqlst)
-flprt("All finished!  " +
-      "Total elapsed time: {0}".format(datetime.datetime.now()-t0))
\ No newline at end of file
+
+# HTTP server for --serve mode, which keeps a Validator (and so all of the
+# reference data) resident in memory, and answers validation requests:
+#
+#     GET /validate?city=NAME&country=CODE
+#         validate one city; returns its result as a JSON object
+#     POST /validate
+#         validate a JSON list of [city, country] pairs; returns a JSON list
+#         of results in the same order
+#     GET /stats
+#         latency statistics for the most recent validation requests
+#     GET /metrics
+#         the Validator's metrics, in the Prometheus text format
+#
+# Results have the same fields as ValidationResult, with null in place of ''
+# for values which aren't known, plus the time taken to answer the request
+class ValidationServer(HTTPServer):
+
+    def __init__(self, address, validator):
+        HTTPServer.__init__(self, address, ValidationHandler)
+        self.validator = validator
+        # Request latencies in seconds, most recent last
+        self.latencies = deque(maxlen=serve_latencies)
+        self.requests = 0
+
+    # Latency statistics for the most recent requests, in milliseconds
+    def stats(self):
+        stats = {"requests": self.requests, "window": len(self.latencies)}
+        if self.latencies:
+            ms = sorted(1000*t for t in self.latencies)
+            stats["mean_ms"] = sum(ms)/len(ms)
+            for name, pct in [("p50_ms", 50), ("p95_ms", 95), ("p99_ms", 99)]:
+                stats[name] = ms[min(len(ms) - 1, len(ms)*pct//100)]
+            stats["max_ms"] = ms[-1]
+        return stats
+
+# The same server, listening on a Unix domain socket instead of a TCP port
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixValidationServer(socketserver.UnixStreamServer,
+                               ValidationServer):
+
+        def server_bind(self):
+            socketserver.UnixStreamServer.server_bind(self)
+            self.server_name = "localhost"
+            self.server_port = 0
+else: # Not available on Windows
+    UnixValidationServer = None
+
+class ValidationHandler(BaseHTTPRequestHandler):
+
+    # Convert a ValidationResult into a dictionary for JSON output
+    def resultdict(self, v):
+        return {k: (None if x == '' else x) for k, x in v._asdict().items()}
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self.reply(200, self.server.stats())
+            return
+        if url.path == "/metrics":
+            data = self.server.validator.metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if url.path != "/validate":
+            self.reply(404, {"error": "no such path: " + url.path})
+            return
+        query = parse_qs(url.query, keep_blank_values=True)
+        if "city" not in query or "country" not in query:
+            self.reply(400, {"error": "city and country are both required"})
+            return
+        try:
+            v = self.server.validator.validate(query["city"][0],
+                                               query["country"][0])
+        except Exception as err:
+            self.failed(err)
+            return
+        self.finish_request(start, self.resultdict(v))
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if urlparse(self.path).path != "/validate":
+            self.reply(404, {"error": "no such path: " + self.path})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            pairs = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(pairs, list) or not all(
+                    isinstance(pair, list) and len(pair) == 2 and
+                    all(isinstance(item, str) for item in pair)
+                    for pair in pairs):
+                raise ValueError("not a list of pairs of strings")
+            pairs = [tuple(pair) for pair in pairs]
+        except (ValueError, TypeError, AttributeError):
+            self.reply(400, {"error": "expected a JSON list of " +
+                             "[city, country] pairs"})
+            return
+        try:
+            results = [self.resultdict(v) for v in
+                       self.server.validator.validate_batch(pairs)]
+        except Exception as err:
+            self.failed(err)
+            return
+        self.finish_request(start, {"results": results})
+
+    # Report an unexpected error in validation, without stopping the server
+    def failed(self, err):
+        self.log_error("validation failed: %r", err)
+        self.reply(500, {"error": "{0}: {1}".format(type(err).__name__, err)})
+
+    # Send a successful reply, and record how long it took to produce
+    def finish_request(self, start, body):
+        elapsed = time.perf_counter() - start
+        body["elapsed_ms"] = 1000*elapsed
+        self.reply(200, body)
+        self.server.latencies.append(elapsed)
+        self.server.requests = self.server.requests + 1
+        self.server.validator.metrics.writesnapshot()
+
+    # Unix domain socket clients have no address to log
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPRequestHandler.address_string(self)
+        return "local"
+
+    def log_message(self, format, *args):
+        if self.server.validator.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Answer validation requests until interrupted (see ValidationServer)
+def serve(validator, host, port, socketpath=None):
+    if socketpath is not None:
+        if UnixValidationServer is None:
+            raise OSError("Unix domain sockets are not supported here")
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        server = UnixValidationServer(socketpath, validator)
+        where = socketpath
+    else:
+        server = ValidationServer((host, port), validator)
+        where = "http://{0}:{1}/".format(*server.server_address[:2])
+    validator.log("Serving validation requests at " + where +
+                  "; press Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketpath is not None and os.path.exists(socketpath):
+            os.remove(socketpath)
+    validator.log("Served {0} requests".format(server.requests))
+
+# Name of the manifest file in a directory of shards, which records where
+# the input file came from and which countries went into each shard
+shard_manifest = "manifest.json"
+
+# Path of one of the files belonging to shard number k in a directory of
+# shards: its part of the input file, or its output files
+def shardfile(dirname, k, name):
+    return os.path.join(dirname, "shard-{0}".format(k), name)
+
+# Number of rows for each country in the city spelling file, judging by the
+# country code at the start of each line (as in countrylines)
+def countrysizes(filename):
+    sizes = {}
+    with opencities(filename) as file:
+        next(file) # Skip column headers in first line
+        for line in file:
+            code = line[:line.find(",")]
+            sizes[code] = sizes.get(code, 0) + 1
+    ctsizes = {}
+    for code, n in sizes.items():
+        ctry = normalize.upper(code)
+        ctsizes[ctry] = ctsizes.get(ctry, 0) + n
+    return ctsizes
+
+# Assign each country to one of nshards shards, so that the total cost of the
+# countries in each shard is about the same: each country in turn, most
+# costly first, goes into the shard with the lowest total so far.  Ties are
+# broken by country code and shard number, so that the assignment is always
+# the same for the same costs.  Returns the assignment and the shard totals
+def assignshards(costs, nshards):
+    totals = [0]*nshards
+    assignment = {}
+    for ctry in sorted(costs.keys(), key=lambda ctry: (-costs[ctry], ctry)):
+        k = min(range(nshards), key=lambda k: (totals[k], k))
+        assignment[ctry] = k
+        totals[k] = totals[k] + costs[ctry]
+    return assignment, totals
+
+# Split the input file into nshards shards by country, in a directory with one
+# subdirectory per shard, each holding the lines of the input file for its
+# countries (in their original order).  Each shard can then be validated on
+# its own with --run-shard, loading only the reference data for its
+# countries, and the results put back together with --merge.  The cost of a
+# country is estimated from the number of rows that it has in the city
+# spelling file (plus one, for any country that isn't in there at all)
+def shardinput(inputfile, cityspelling_file, nshards, dirname):
+    countries = prescan(inputfile)
+    sizes = countrysizes(cityspelling_file)
+    costs = {ctry: sizes.get(ctry, 0) + 1 for ctry in countries}
+    assignment, totals = assignshards(costs, nshards)
+    counts = [0]*nshards
+    outfiles = []
+    try:
+        for k in range(nshards):
+            os.makedirs(os.path.dirname(shardfile(dirname, k, "")),
+                        exist_ok=True)
+            outfiles.append(open(shardfile(dirname, k, "input.txt"), "w",
+                                 encoding=file_encoding))
+        with open(inputfile, "r", encoding=file_encoding) as infile:
+            # Keep the lines that each record was parsed from, so that they
+            # can be copied to the shard exactly as they are
+            raw = []
+            def lines():
+                for line in infile:
+                    raw.append(line)
+                    yield line
+            alldata = csv.reader(lines(), delimiter = "|", quotechar="'")
+            next(alldata) # Copy column headers in first line to every shard
+            for outfile in outfiles:
+                outfile.writelines(raw)
+            del raw[:]
+            for city, ctry in alldata:
+                k = assignment[ctry]
+                outfiles[k].writelines(raw)
+                counts[k] = counts[k] + 1
+                del raw[:]
+    finally:
+        for outfile in outfiles:
+            outfile.close()
+    manifest = {"input": os.path.abspath(inputfile),
+                "sha1": filehash(inputfile),
+                "shards": [{"countries": sorted(ctry for ctry in assignment
+                                                if assignment[ctry] == k),
+                            "cost": totals[k], "lines": counts[k]}
+                           for k in range(nshards)]}
+    with open(os.path.join(dirname, shard_manifest), "w",
+              encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+        file.write("\n")
+    return manifest
+
+def readmanifest(dirname):
+    with open(os.path.join(dirname, shard_manifest), "r",
+              encoding="utf-8") as file:
+        return json.load(file)
+
+# Put the output files of all of the shards in a directory of shards back
+# together, into the same processed and unique cities files that validating
+# the whole input file at once would have produced: the processed lines are
+# taken from each shard in turn in the order of the original input file, and
+# the unique cities (each shard's are already sorted, and no city is in more
+# than one shard) are merged in quality, country, city order
+def mergeshards(dirname, processedfile, uniquefile):
+    manifest = readmanifest(dirname)
+    nshards = len(manifest["shards"])
+    assignment = {}
+    for k in range(nshards):
+        for ctry in manifest["shards"][k]["countries"]:
+            assignment[ctry] = k
+    infiles = []
+    try:
+        for k in range(nshards):
+            infiles.append(open(shardfile(dirname, k, processed_file), "r",
+                                encoding=file_encoding))
+            next(infiles[k]) # Skip column headers in first line
+        with open(manifest["input"], "r", encoding=file_encoding) as infile, \
+             open(processedfile, "w", encoding=file_encoding) as outfile:
+            outfile.writelines(column_headers)
+            alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+            next(alldata) # Skip column headers in first line
+            for city, ctry in alldata:
+                k = assignment[ctry]
+                line = next(infiles[k], None)
+                if line is None:
+                    raise ValueError("Output of shard {0} ".format(k) +
+                                     "is missing some lines")
+                outfile.writelines(line)
+        for k in range(nshards):
+            if next(infiles[k], None) is not None:
+                raise ValueError("Output of shard {0} ".format(k) +
+                                 "has too many lines")
+    finally:
+        for file in infiles:
+            file.close()
+    infiles = []
+    try:
+        for k in range(nshards):
+            infiles.append(open(shardfile(dirname, k, unique_file), "r",
+                                encoding=file_encoding))
+            next(infiles[k]) # Skip column headers in first line
+        with open(uniquefile, "w", encoding=file_encoding) as outfile:
+            outfile.writelines(column_headers)
+            outfile.writelines(heapq.merge(*infiles, key=uniquekey))
+    finally:
+        for file in infiles:
+            file.close()
+
+# Sort key of a line of the unique cities file: quality indicator, then
+# country, then city (see run)
+def uniquekey(line):
+    fields = next(csv.reader([line], quotechar = "'"))
+    return int(fields[2]), fields[1], fields[0]
+
+def main(argv=None):
+    global t0
+    t0 = datetime.datetime.now()
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.memory_budget < 1:
+        parser.error("--memory-budget must be at least 1")
+    if args.compact_result_cache and args.result_cache is None:
+        parser.error("--compact-result-cache requires --result-cache")
+    if args.workers > 1 and \
+       "fork" not in multiprocessing.get_all_start_methods():
+        parser.error("--workers requires a platform which supports fork()")
+    if args.socket is not None and UnixValidationServer is None:
+        parser.error("--socket requires a platform with Unix domain sockets")
+    if not os.path.exists(args.cities) and \
+       os.path.exists(args.cities + ".gz"):
+        args.cities = args.cities + ".gz"
+    if args.slowest < 0:
+        parser.error("--slowest must not be negative")
+    if args.max_edit_distance < 1:
+        parser.error("--max-edit-distance must be at least 1")
+    if sum([args.serve, args.shard is not None, args.run_shard is not None,
+            args.merge]) > 1:
+        parser.error("only one of --serve, --shard, --run-shard and --merge " +
+                     "can be given")
+    if args.shard is not None and args.shard < 1:
+        parser.error("--shard must be at least 1")
+    if args.run_shard is not None or args.merge:
+        try:
+            manifest = readmanifest(args.shard_dir)
+        except (IOError, OSError, ValueError):
+            parser.error("--shard-dir " + args.shard_dir + " doesn't " +
+                         "contain a set of shards made by --shard")
+    if args.run_shard is not None:
+        if not 0 <= args.run_shard < len(manifest["shards"]):
+            parser.error("--run-shard must be less than the number of " +
+                         "shards, {0}".format(len(manifest["shards"])))
+        args.input = shardfile(args.shard_dir, args.run_shard, "input.txt")
+        args.processed = shardfile(args.shard_dir, args.run_shard,
+                                   processed_file)
+        args.unique = shardfile(args.shard_dir, args.run_shard, unique_file)
+    if args.merge:
+        if not os.path.exists(manifest["input"]) or \
+           filehash(manifest["input"]) != manifest["sha1"]:
+            parser.error("input file " + manifest["input"] + " has " +
+                         "changed since it was split into shards")
+        for k in range(len(manifest["shards"])):
+            for name in [processed_file, unique_file]:
+                if not os.path.exists(shardfile(args.shard_dir, k, name)):
+                    parser.error("shard {0} has no ".format(k) +
+                                 shardfile(args.shard_dir, k, name) +
+                                 "; run it with --run-shard " +
+                                 "{0} before --merge".format(k))
+    if args.shard is not None:
+        manifest = shardinput(args.input, args.cities, args.shard,
+                              args.shard_dir)
+        for k in range(args.shard):
+            shard = manifest["shards"][k]
+            flprt("Shard {0}: {1} countries, {2} lines, cost {3}".format(
+                  k, len(shard["countries"]), shard["lines"], shard["cost"]))
+        flprt("Input file is split into {0} shards in ".format(args.shard) +
+              args.shard_dir)
+        return
+    if args.merge:
+        try:
+            mergeshards(args.shard_dir, args.processed, args.unique)
+        except ValueError as err: # e.g., a shard which is still running
+            parser.error(str(err))
+        flprt("Output files of {0} shards ".format(len(manifest["shards"])) +
+              "are merged into " + args.processed + " and " + args.unique)
+        return
+    if args.profile is None:
+        run(args)
+    else:
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(run, args)
+        finally:
+            profile.dump_stats(args.profile)
+            flprt("Profile is written to " + args.profile)
+
+def run(args):
+    global worker_validator
+    stats = Metrics(args.slowest)
+    if args.metrics is not None:
+        stats.snapshotto(args.metrics, args.metrics_format,
+                         args.metrics_interval)
+
+    # Compacting the result cache only needs the version of the reference
+    # data, not the reference data itself (or the input file)
+    if args.compact_result_cache:
+        ctrymap, invcmap = loadcountrymap(args.country_map)
+        version = resultversion(fingerprint(args.cities), args.airports,
+                                ctrymap, invcmap, args.matcher,
+                                args.max_edit_distance)
+        resultcache = openresultcache(args.result_cache, version)
+        flprt("Removed {0} stale entries ".format(
+              compactresultcache(resultcache)) +
+              "from result cache " + args.result_cache)
+        resultcache[0].close()
+        return
+
+    # Find out which countries the input file has cities in, so that only
+    # the reference data for those countries needs to be loaded
+    if args.serve or args.load_all:
+        countries = None
+    else:
+        with stats.stage("input_prescan"):
+            countries = prescan(args.input)
+        flprt("Input file has cities in {0} countries; ".format(
+              len(countries)) +
+              "{0} elapsed".format(datetime.datetime.now()-t0))
+
+    # Load the reference data (parts III through V)
+    validator = Validator(args.country_map, args.cities, args.airports,
+                          metrics=stats, matcher=args.matcher,
+                          maxdistance=args.max_edit_distance,
+                          countries=countries, workers=args.workers)
+    if peakmemory() is not None:
+        flprt("Peak resident memory while loading reference data: " +
+              "{0} MB".format(peakmemory()))
+    stats.writesnapshot()
+    if args.serve:
+        serve(validator, args.host, args.port, args.socket)
+        stats.writesnapshot(force=True)
+        return
+
+    # Open the persistent cache of results from previous runs, if any
+    if args.result_cache is not None:
+        resultcache = openresultcache(args.result_cache, validator.version())
+    else:
+        resultcache = None
+
+    flprt("Data validation in process, please wait; " +
+          "periodic progress updates will be provided every 3 minutes or " +
+          "so...")
+    prevseen = {}
+    unqlst = []
+    if args.workers > 1:
+        # Build the matching indices for every country in the input up
+        # front, so that the forked worker processes all share a single copy
+        # of them
+        with stats.stage("blocking_index"):
+            if countries is None:
+                countries = prescan(args.input)
+            validator.prepare(countries)
+        worker_validator = validator
+        pool = multiprocessing.get_context("fork").Pool(args.workers)
+        flprt("Validating with {0} worker processes; ".format(args.workers) +
+              "{0} elapsed".format(datetime.datetime.now()-t0))
+    else:
+        pool = None
+    if args.streaming:
+        # Two pass mode: collect the unique cities from the input file,
+        # validate each of them once, and then make a second pass through the
+        # input file to write out the results in order.  Only a bounded number
+        # of unique cities is ever held in memory at one time
+        maxpairs = args.memory_budget*1024*1024//2//streaming_pair_bytes
+        pairsdb, pairsdbfile = openpairsdb(args.memory_budget)
+        with stats.stage("input_read"), \
+             open(args.input, "r", encoding=file_encoding) as infile:
+            alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+            next(alldata) # Skip column headers in first line
+            nlines = collectpairs(alldata, pairsdb, maxpairs)
+        flprt("Unique cities are collected from {0} lines; ".format(nlines) +
+              "{0} elapsed".format(datetime.datetime.now()-t0))
+        with stats.stage("validation"):
+            npairs = resolvepairs(validator, pairsdb, pool,
+                                  args.workers*worker_chunk*16, resultcache)
+        stats.count("input_lines", nlines)
+        stats.count("prevseen_hits", nlines - npairs)
+        stats.writesnapshot()
+        with stats.stage("output_writing"), \
+             open(args.input, "r", encoding=file_encoding) as infile, \
+             open(args.processed, "w", encoding=file_encoding) as outfile:
+            # Print column headers to output file
+            outfile.writelines(column_headers)
+            alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+            next(alldata) # Skip column headers in first line
+            writeprocessed(alldata, outfile, pairsdb, maxpairs)
+        flprt("Data validation is finished; " +
+              "{0} elapsed!".format(datetime.datetime.now()-t0))
+    else:
+        # Read in the unvalidated file batch by batch and attempt to correct
+        # it.  The cities in each batch which haven't been seen before are
+        # validated first (in parallel, if there are worker processes), and
+        # then every line of the batch is written out, in order
+        with open(args.input, "r", encoding=file_encoding) as infile, \
+             open(args.processed, "w", encoding=file_encoding) as outfile:
+            # Print column headers to output file
+            outfile.writelines(column_headers)               
+            alldata = csv.reader(infile, delimiter = "|", quotechar="'")
+            next(alldata) # Skip column headers in first line
+            ii = 1 # Line counter (this seems to be only way to do it in Python)
+            for lines, newpairs in stats.timediter("input_read",
+                    readbatches(alldata, prevseen,
+                                args.workers*worker_chunk*16, batch_lines)):
+                stats.count("input_lines", len(lines))
+                stats.count("prevseen_hits", len(lines) - len(newpairs))
+                # Add each new city to the dictionary of previously seen
+                # cities, and to the list of unique cities (basically same
+                # underlying data, but different formating)
+                with stats.stage("validation"):
+                    for v in validatepairs(validator, newpairs, pool,
+                                           resultcache):
+                        prevseen[v[1]][v[0]] = outputline(v)
+                        unqlst.append(v)
+                with stats.stage("output_writing"):
+                    for city, ctry in lines:
+                        outfile.writelines(prevseen[ctry][city])
+                        if not ii%10000: # Send periodic status update
+                            flprt("    {0} lines finished; ".format(ii) +
+                                  "{0} elapsed".format(
+                                  datetime.datetime.now()-t0))
+                        ii = ii + 1
+                stats.writesnapshot()
+            flprt("Data validation is finished; " +
+                  "{0} elapsed!".format(datetime.datetime.now()-t0))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    flprt("Dumping unique cities list to output file; please wait...")
+    with stats.stage("unique_output"):
+        # Sort the list of unique cities by quality indicator first, then
+        # alphabetically by country, and finally alphabetically by city
+        if args.streaming:
+            # Let the database do the sorting, so that it can spill to disk
+            unqlst = pairsdb.execute("SELECT city, ctry, quality, " +
+                                     "cityascii, cityaccent, ctryname, lat, " +
+                                     "lon FROM resolved ORDER BY quality, " +
+                                     "ctry, city")
+        else:
+            unqlst = sorted(unqlst, key=itemgetter(2, 1, 0))
+        with open(args.unique, "w", encoding=file_encoding) as outfile:
+            # Print column headers to output file
+            outfile.writelines(column_headers)
+            # Print data to the output file
+            writer = csv.writer(outfile, quotechar = "'",
+                                quoting=csv.QUOTE_NONNUMERIC,
+                                lineterminator='\n')
+            writer.writerows(unqlst)
+    if args.streaming:
+        pairsdb.close()
+        os.remove(pairsdbfile)
+    if resultcache is not None:
+        flprt("Result cache: {0} hits, {1} misses".format(
+              resultcache[2]["hits"], resultcache[2]["misses"]))
+        resultcache[0].close()
+    stats.writesnapshot(force=True)
+    flprt("Time spent in each stage: " +
+          ", ".join("{0} {1:.2f} s".format(name, seconds)
+                    for name, seconds in stats.stages.items()))
+    flprt("All finished!  " +
+          "Total elapsed time: {0}".format(datetime.datetime.now()-t0))
+
+if __name__ == "__main__":
+    main()